@@ -1,95 +1,110 @@
-from dash import Dash, dcc, html, Input, Output, State, dash, ALL, callback_context
+from dash import Dash, dcc, html, Input, Output, State, dash, ALL, callback_context, callback, clientside_callback
 import dash_leaflet as dl
-import requests
 import json
-from tsp_logic import TSPSolverInterface
+from tsp_logic import TSPSolverInterface, SolveJobManager, SolveProfiler
 import os
-import folium
 import webbrowser
-import tkinter as tk
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 os.chdir(dir_path)
-API_KEY = open('API_KEY.txt', 'r').read()
 
+# Set when the app is started below. The solve jobs run in spawned processes that import this module again, so
+# importing it must not create another solver interface, job pool or Dash app
+TSPInterface = None
+TSPJobs = None
 
-TSPInterface = TSPSolverInterface(API_KEY)
+def create_app():
+    external_stylesheets = [{
+        'href': 'https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css',
+        'rel': 'stylesheet',
+    }]
+    # The callbacks below are registered with dash.callback and apply to this app
+    app = Dash(__name__, external_stylesheets=external_stylesheets)
 
-external_stylesheets = [{
-    'href': 'https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0/css/bootstrap.min.css',
-    'rel': 'stylesheet',
-}]
-app = Dash(__name__, external_stylesheets=external_stylesheets)
-
-
-app.layout = html.Div([
-    html.Div([
+    app.layout = html.Div([
         html.Div([
             html.Div([
-                html.Label('Location:'),
-                dcc.Input(type='text', id='location', name='location'),
-                html.Button('Search', id='search-button', n_clicks=0),
-                html.Div(id='error-message', style={'color': 'red'}),
-            ]),
+                html.Div([
+                    html.Label('Location:'),
+                    dcc.Input(type='text', id='location', name='location'),
+                    html.Button('Search', id='search-button', n_clicks=0),
+                    html.Div(id='error-message', style={'color': 'red'}),
+                ]),
             
-            html.Label('Locations:'),
-            html.Div(id='locations-list'),
+                html.Label('Locations:'),
+                html.Div(id='locations-list'),
             
-            html.Label('Mode of transport:'),
-            dcc.Dropdown(
-                id='transport',
-                options=[
-                    {'label': 'Driving', 'value': 'driving'},
-                    {'label': 'Walking', 'value': 'walking'},
-                    {'label': 'Cycling', 'value': 'cycling'},
-                ],
-                value='driving'
-            ),
-
-            html.Label('TSP Solving Method:'),
-            dcc.Dropdown(
-                id='method', # Add new methods here
-                options=[
-                    {'label': 'TwoOpt', 'value': 'TwoOpt'},
-                    {'label': 'Permutations', 'value': 'Permutations'},
-                    {'label': 'FlowBased', 'value': 'FlowBased'},
-                    {'label': 'ConstraintProgramming', 'value': 'ConstraintProgramming'},
-                ],
-                value='TwoOpt'
-            ),
-            html.Div([
-            html.Label('Time Limit (seconds):', style={'marginRight': '10px'}),
-            dcc.Input(type='number', id='time-limit', min=0, step=1, value=60, style={'textAlign': 'right', 'width': '15%'}),  # Adjusted width to 50%
-            ], style={'marginTop': '10px', 'display': 'flex', 'alignItems': 'center'}),
-
-            html.Button('Submit', id='submit-button', n_clicks=0, style={'marginTop': '10px'}),
-            html.Button('Open in new Tab', id='open-tab-button', n_clicks=0, style={'marginLeft': '10px'}),
-            html.Button('Save Route', id='save-route-button', n_clicks=0, style={'marginLeft': '10px'}),
-            html.Div(
-            dcc.Loading(
-                id="loading",
-                type="dot",
-                children=[
-                    html.Div([html.Strong(id='info')]),  # This is where information about the route will be displayed if nessesary 
-                    html.Div(id='path-display'),  # This is where the path will be displayed
-                    html.Div(id='travel-time-display') # This is where the travel time will be displayed
-                ]
+                html.Label('Mode of transport:'),
+                dcc.Dropdown(
+                    id='transport',
+                    options=[
+                        {'label': 'Driving', 'value': 'driving'},
+                        {'label': 'Walking', 'value': 'walking'},
+                        {'label': 'Cycling', 'value': 'cycling'},
+                    ],
+                    value='driving'
+                ),
+
+                html.Label('TSP Solving Method:'),
+                dcc.Dropdown(
+                    id='method', # Add new methods here
+                    options=[
+                        {'label': 'TwoOpt', 'value': 'TwoOpt'},
+                        {'label': 'IteratedLocalSearch', 'value': 'IteratedLocalSearch'},
+                        {'label': 'Permutations', 'value': 'Permutations'},
+                        {'label': 'HeldKarp', 'value': 'HeldKarp'},
+                        {'label': 'FlowBased', 'value': 'FlowBased'},
+                        {'label': 'FlowBased (lazy subtour cuts)', 'value': 'FlowBasedDFJ'},
+                        {'label': 'ConstraintProgramming', 'value': 'ConstraintProgramming'},
+                        {'label': 'ConstraintProgramming (guided local search)', 'value': 'ConstraintProgrammingGLS'},
+                        {'label': 'Portfolio (all methods in parallel)', 'value': 'Portfolio'},
+                        {'label': 'ClusterDecomposition (thousands of stops)', 'value': 'ClusterDecomposition'},
+                    ],
+                    value='TwoOpt'
+                ),
+                html.Div([
+                html.Label('Time Limit (seconds):', style={'marginRight': '10px'}),
+                dcc.Input(type='number', id='time-limit', min=0, step=1, value=60, style={'textAlign': 'right', 'width': '15%'}),  # Adjusted width to 50%
+                ], style={'marginTop': '10px', 'display': 'flex', 'alignItems': 'center'}),
+                html.Div([
+                html.Label('Stop at gap (%):', style={'marginRight': '10px'}),
+                dcc.Input(type='number', id='gap-target', min=0, step=0.1, placeholder='off', style={'textAlign': 'right', 'width': '15%'}),  # Stop once the route is proven to be within this percentage of the optimum
+                ], style={'marginTop': '10px', 'display': 'flex', 'alignItems': 'center'}),
+
+                html.Button('Submit', id='submit-button', n_clicks=0, style={'marginTop': '10px'}),
+                html.Button('Cancel', id='cancel-button', n_clicks=0, style={'marginLeft': '10px'}),
+                html.Button('Open in new Tab', id='open-tab-button', n_clicks=0, style={'marginLeft': '10px'}),
+                html.Button('Save Route', id='save-route-button', n_clicks=0, style={'marginLeft': '10px'}),
+                html.Div(
+                dcc.Loading(
+                    id="loading",
+                    type="dot",
+                    children=[
+                        html.Div([html.Strong(id='info')]),  # This is where information about the route will be displayed if nessesary 
+                        html.Div(id='path-display'),  # This is where the path will be displayed
+                        html.Div(id='travel-time-display') # This is where the travel time will be displayed
+                    ]
+                ),
+                style={'marginTop': '20px'}  # Add some margin at the top
             ),
-            style={'marginTop': '20px'}  # Add some margin at the top
-        ),
+            ],
+            id='inputForm'),
         ],
-        id='inputForm'),
-    ],
-    id='sidebar', style={'float': 'left', 'width': '30%', 'height': '100%', 'overflow': 'auto', 'padding': '10px', 'box-sizing': 'border-box', 'border-right': '1px solid #ccc'}),
-
-    dl.Map(id='map', style={'float': 'right', 'width': '70%', 'height': '100vh', 'position': 'relative', 'z-index': 0}, center=[0, 0], zoom=2, children=[
-        dl.TileLayer(url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png")
-    ]),
-    html.Div(id='map-marker-store', style={'display': 'none'}),  # Hidden div to store the updated map marker
-    html.Div(id='locations-store', style={'display': 'none'}),  # Hidden div to store the added locations
-], style={'height': '100vh'})
-
-@app.callback(
+        id='sidebar', style={'float': 'left', 'width': '30%', 'height': '100%', 'overflow': 'auto', 'padding': '10px', 'box-sizing': 'border-box', 'border-right': '1px solid #ccc'}),
+
+        dl.Map(id='map', style={'float': 'right', 'width': '70%', 'height': '100vh', 'position': 'relative', 'z-index': 0}, center=[0, 0], zoom=2, trackViewport=True, children=[
+            dl.TileLayer(url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"),
+            dl.Polyline(id='route-line', positions=[], color="red", weight=2.5, opacity=1)
+        ]),
+        html.Div(id='map-marker-store', style={'display': 'none'}),  # Hidden div to store the updated map marker
+        html.Div(id='locations-store', style={'display': 'none'}),  # Hidden div to store the added locations
+        dcc.Store(id='job-id'),  # Id of the running background solve
+        dcc.Interval(id='job-poll', interval=1000, disabled=True),  # Polls the running solve for progress
+        dcc.Store(id='route-store'),  # Road geometry of the found route as encoded polyline with a zoom level per point
+    ], style={'height': '100vh'})
+    return app
+
+@callback(
     [Output('locations-store', 'children'),
      Output('map-marker-store', 'children'),
      Output('location', 'value'),
@@ -115,11 +130,9 @@ def update_locations(n_clicks, delete_n_clicks, location, locations_json):
         if button_id == 'search-button':
             if n_clicks and location:
                 try:
-                    response = requests.get(f"http://nominatim.openstreetmap.org/search?q={location}&format=json")
-                    json_response = response.json()
-                    if json_response:
-                        latitude = float(json_response[0]['lat'])
-                        longitude = float(json_response[0]['lon'])
+                    coordinates = TSPInterface.calculator.geocode(location)  # Goes through the shared geocode cache
+                    if coordinates:
+                        longitude, latitude = coordinates
                         new_marker_position = [latitude, longitude]
                         locations.append({'name': location, 'position': new_marker_position})
                         bounds = compute_bounds(locations)  # Compute bounds after adding the new location
@@ -149,7 +162,7 @@ def compute_bounds(locations):
     else:
         return dash.no_update  # Default bounds, can be adjusted as needed
 
-@app.callback(
+@callback(
     Output('locations-list', 'children'),
     Input('locations-store', 'children')
 )
@@ -158,24 +171,31 @@ def update_locations_list(locations_json):
     return html.Ul([html.Li([location['name'], html.Button('X', id={'type': 'delete-button', 'index': i})]) for i, location in enumerate(locations)])  # Create a list item for each location with a delete button
 
 #General callback for updating the map - needs to be all in one function because of Dash limitations
-@app.callback(
+@callback(
     [Output('info', 'children'),
      Output('path-display', 'children'),
      Output('travel-time-display', 'children'),
-     Output('map', 'children'),],
+     Output('map', 'children'),
+     Output('job-id', 'data'),
+     Output('job-poll', 'disabled'),
+     Output('route-store', 'data')],
     [Input('submit-button', 'n_clicks'),
      Input('map-marker-store', 'children'),
      Input('open-tab-button', 'n_clicks'),
-     Input('save-route-button', 'n_clicks')],
+     Input('save-route-button', 'n_clicks'),
+     Input('job-poll', 'n_intervals'),
+     Input('cancel-button', 'n_clicks')],
     [State('locations-store', 'children'),
      State('transport', 'value'),
      State('method', 'value'),
      State('time-limit', 'value'),
+     State('gap-target', 'value'),
      State('map', 'children'),
-     State('path-display', 'children')],
+     State('path-display', 'children'),
+     State('job-id', 'data')],
     prevent_initial_call=True
 )
-def combined_callback(submit_n_clicks, marker_store, open_tab_n_clicks, save_route_n_clicks, locations_json, transport_mode, tsp_method, time_limit, map_children, current_path_display):
+def combined_callback(submit_n_clicks, marker_store, open_tab_n_clicks, save_route_n_clicks, poll_n_intervals, cancel_n_clicks, locations_json, transport_mode, tsp_method, time_limit, gap_target, map_children, current_path_display, job_id):
     ctx = callback_context
 
     # Check if the submit-button was clicked
@@ -185,50 +205,38 @@ def combined_callback(submit_n_clicks, marker_store, open_tab_n_clicks, save_rou
 
         # Check if there are less than 2 locations
         if len(locations) < 2:
-            return "Please add at least two locations to compute a route.", "", "", dash.no_update
+            return "Please add at least two locations to compute a route.", "", "", dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
         # Extract the names of the locations
         location_names = [location['name'] for location in locations]
-        # Call the TSPSolverInterface's solve_tsp method
-        optimal, ordered_locations, total_time_for_route, route = TSPInterface.solve_tsp(location_names, transport_mode, tsp_method, time_limit)
-
-        if route is None:
-            return "Impossible Route or error in request. Check Terminal for additional information.", "", "", dash.no_update
-
-        # Format the ordered locations into a readable string
-        path_string = ' -> '.join(ordered_locations)
-
-        # Display the total time for the route
-        hours = int(total_time_for_route // 60)
-        minutes = int(total_time_for_route % 60)
-
-        if hours > 0:
-            travel_time_string = f"Total Duration: {hours} hour(s) and {minutes} minute(s)"
-        else:
-            travel_time_string = f"Total Duration: {minutes} minute(s)"
-
-        # Remove any existing polyline
-        map_children = [child for child in map_children if child['type'] != 'Polyline']
-
-        # Add the new route to the map
-        polyline = dl.Polyline(positions=route, color="red", weight=2.5, opacity=1)
-        map_children.append(polyline)
-
-        if optimal:
-            return "Optimal Route Found", path_string, travel_time_string, map_children
-        else:
-            return "Suboptimal Route Found, solver didn't finish", path_string, travel_time_string, map_children
+        # Reuse the positions found during the search (stored as [lat, lon], the solver expects (lon, lat))
+        location_coordinates = [(location['position'][1], location['position'][0]) for location in locations]
+        # A solve that is still running for the previous submit would otherwise hold a worker until its time limit
+        if job_id:
+            TSPJobs.cancel(job_id)
+        # Start the solve in the background and poll for its progress
+        new_job_id = TSPJobs.submit(location_names, transport_mode, tsp_method, time_limit, location_coordinates,
+                                    gap_target / 100 if gap_target is not None else None)
+        return "Solving...", "", "", dash.no_update, new_job_id, False, None  # None removes the previous route
+
+    elif ctx.triggered[0]['prop_id'] == 'cancel-button.n_clicks':
+        if job_id:
+            TSPJobs.cancel(job_id)  # The next poll shows the best route found so far
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+    elif ctx.triggered[0]['prop_id'] == 'job-poll.n_intervals':
+        return poll_job(job_id, locations_json, map_children)
 
     # Check if the open-tab-button was clicked
     elif ctx.triggered[0]['prop_id'] == 'open-tab-button.n_clicks':
         # Check if there is a path to display or a message indicating that the user should generate a route first
         if not current_path_display or current_path_display.startswith("Please"):
-            return "Please generate Route first.", dash.no_update, dash.no_update, dash.no_update
+            return "Please generate Route first.", dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
         webbrowser.open('temp_route_visualization.html', new=2)
-        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
     
     elif ctx.triggered[0]['prop_id'] == 'save-route-button.n_clicks':
-        return save_route(locations_json, current_path_display)
+        return save_route(locations_json, current_path_display) + (dash.no_update, dash.no_update, dash.no_update)
 
     else:
         # Handle the logic for updating markers
@@ -237,7 +245,121 @@ def combined_callback(submit_n_clicks, marker_store, open_tab_n_clicks, save_rou
         non_marker_children = [child for child in map_children if child['type'] != 'Marker']
         map_children = non_marker_children + markers
 
-        return dash.no_update, dash.no_update, dash.no_update, map_children
+        return dash.no_update, dash.no_update, dash.no_update, map_children, dash.no_update, dash.no_update, dash.no_update
+
+# Draws the route in the browser: decodes the encoded polyline of route-store and keeps the points visible at the
+# current zoom, so zooming never needs the server and the full geometry is never sent as a list of numbers
+clientside_callback(
+    """
+    function(route, zoom) {
+        if (!route) {
+            return [];
+        }
+        var positions = [], values = [], value = 0, shift = 0;
+        for (var i = 0; i < route.points.length; i++) {
+            var chunk = route.points.charCodeAt(i) - 63;
+            value |= (chunk & 0x1f) << shift;
+            shift += 5;
+            if (chunk < 0x20) {
+                values.push(value & 1 ? ~(value >> 1) : value >> 1);
+                value = 0;
+                shift = 0;
+            }
+        }
+        var lat = 0, lon = 0;
+        for (var k = 0; 2 * k < values.length; k++) {
+            lat += values[2 * k];
+            lon += values[2 * k + 1];
+            if (route.zooms.charCodeAt(k) - 63 <= zoom) {
+                positions.push([lat / 1e5, lon / 1e5]);
+            }
+        }
+        return positions;
+    }
+    """,
+    Output('route-line', 'positions'),
+    [Input('route-store', 'data'),
+     Input('map', 'zoom')]
+)
+
+def poll_job(job_id, locations_json, map_children):
+    job = TSPJobs.status(job_id) if job_id else None
+    if job is None:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, None, True, dash.no_update
+
+    if job['status'] == 'queued':
+        return "Waiting for a free solver...", dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+    if job['status'] == 'running':
+        progress = job['progress']
+        if progress is None:
+            return "Solving...", dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+        # Show the best tour so far as straight lines between the markers
+        locations = json.loads(locations_json) if locations_json else []
+        positions = [locations[i]['position'] for i in progress['tour']]
+        info = f"Solving... best route after {int(progress['elapsed'])} second(s)"
+        if progress['gap'] is not None:
+            info += f", at most {progress['gap']:.1%} longer than the optimum"
+        return info, ' -> '.join(progress['ordered_locations']), format_duration(progress['cost'] / 60), replace_polyline(map_children, positions, dash_array='5, 10'), dash.no_update, dash.no_update, dash.no_update
+
+    if job['status'] == 'failed':
+        print("Solve failed:", job['error'])
+        return "Impossible Route or error in request. Check Terminal for additional information.", "", "", dash.no_update, None, True, dash.no_update
+
+    if job['result'] is None:
+        # Cancelled before the solve started
+        return "Solve cancelled, no route was found", "", "", replace_polyline(map_children, None), None, True, dash.no_update
+
+    # The job is done or was cancelled, either way solve_tsp returned the best route it had
+    optimal, ordered_locations, total_time_for_route, route, quality = job['result']
+
+    # Format the ordered locations into a readable string
+    path_string = ' -> '.join(ordered_locations)
+
+    if route is None:
+        # Cancelled, or the road geometry couldn't be fetched: keep the route as straight lines between the markers
+        positions = {location['name']: location['position'] for location in (json.loads(locations_json) if locations_json else [])}
+        map_children = replace_polyline(map_children, [positions[name] for name in ordered_locations])
+    else:
+        # Replace the straight lines of the progress with the road geometry, which the browser decodes for its zoom
+        map_children = replace_polyline(map_children, None)
+
+    if optimal:
+        info = "Optimal Route Found"
+    elif quality['gap'] is None:
+        # Solved with candidate travel times, the estimated ones give no valid bound
+        info = "Solve cancelled, the best route found is shown" if job['status'] == 'cancelled' else "Route Found"
+    elif job['status'] == 'cancelled':
+        info = f"Solve cancelled, the best route found is at most {quality['gap']:.1%} longer than the optimum"
+    else:
+        info = f"Route Found, at most {quality['gap']:.1%} longer than the optimum"
+    if route is None:
+        info += " (without road geometry)"
+
+    # Where the time of the solve went, collapsed below the travel time
+    travel_time = format_duration(total_time_for_route)
+    if job.get('timing') is not None:
+        timing = SolveProfiler.format(job['timing'])
+        print("Timing", timing)
+        travel_time = [travel_time, html.Details([html.Summary('Timing'), html.Pre(timing, style={'fontSize': 'small'})])]
+    return info, path_string, travel_time, map_children, None, True, route.encoded() if route is not None else None
+
+def replace_polyline(map_children, positions, dash_array=None):
+    # Remove any existing polyline of the progress (the route line is drawn from route-store), positions=None only removes it
+    map_children = [child for child in map_children if child['type'] != 'Polyline' or child['props'].get('id') == 'route-line']
+    if positions is not None:
+        map_children.append(dl.Polyline(positions=positions, color="red", weight=2.5, opacity=1, dashArray=dash_array))
+    return map_children
+
+def format_duration(total_minutes):
+    # Display the total time for the route
+    hours = int(total_minutes // 60)
+    minutes = int(total_minutes % 60)
+
+    if hours > 0:
+        return f"Total Duration: {hours} hour(s) and {minutes} minute(s)"
+    else:
+        return f"Total Duration: {minutes} minute(s)"
 
 def save_route(locations_json, current_path_display):
     # Check if there is a path to display or a message indicating that the user should generate a route first
@@ -263,6 +385,8 @@ def save_route(locations_json, current_path_display):
     return f"Route has beenn saved in the 'saved_routes' Folder as '{file_name}.html'", "", "", dash.no_update
 
 def get_user_input():
+    import tkinter as tk  # Only needed when a route is saved
+
     # Create the main window
     root = tk.Tk()
     root.title("Input Window")
@@ -312,4 +436,8 @@ def get_user_input():
     return user_input.get()
 
 if __name__ == '__main__':
+    API_KEY = open('API_KEY.txt', 'r').read()
+    TSPInterface = TSPSolverInterface(API_KEY)
+    TSPJobs = SolveJobManager(API_KEY)  # Solves run in background processes, the page polls for their progress
+    app = create_app()
     app.run_server(debug=True)
\ No newline at end of file
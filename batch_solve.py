@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import sys
+from tsp_logic import solve_batch
+
+# Solves a JSONL file of TSP instances without the app and writes one JSON result per line, e.g.
+#   python batch_solve.py jobs.jsonl -o results.jsonl --time-limit 30
+# Every input line is a job as described in tsp_logic.solve_batch, for example
+#   {"id": "monday", "locations": ["Berlin", "Hamburg", "Munich"], "mode": "driving", "method": "IteratedLocalSearch"}
+#   {"id": "depot-7", "matrix": [[0, 60, 90], [60, 0, 45], [90, 45, 0]], "max_time_seconds": 5}
+
+
+def read_jobs(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solve many TSP instances from a JSONL file")
+    parser.add_argument('jobs', help="JSONL file with one job per line, - for stdin")
+    parser.add_argument('-o', '--output', default='-', help="JSONL file for the results, - for stdout (default)")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: all cores)")
+    parser.add_argument('--time-limit', type=float, default=10, help="Seconds per job unless the job sets max_time_seconds")
+    parser.add_argument('--visualize', action='store_true', help="Render an html map per job")
+    parser.add_argument('--output-dir', default='.', help="Directory for the html maps")
+    parser.add_argument('--profile', action='store_true', help="Add cProfile statistics to the timing of every result")
+    parser.add_argument('--api-key-file', default='API_KEY.txt', help="OpenRouteService key, only needed for jobs without a matrix")
+    parser.add_argument('--cache', default='travel_cache.sqlite', help="Path of the travel cache, empty to disable it")
+    args = parser.parse_args()
+
+    API_KEY = None
+    if os.path.exists(args.api_key_file):
+        API_KEY = open(args.api_key_file, 'r').read().strip()
+
+    jobs_file = sys.stdin if args.jobs == '-' else open(args.jobs, 'r', encoding='utf-8')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    solved = failed = 0
+    try:
+        for result in solve_batch(read_jobs(jobs_file), API_KEY, args.cache or None, args.workers, args.time_limit,
+                                  args.visualize, args.output_dir, profile=args.profile):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            if result['status'] == 'done':
+                solved += 1
+            else:
+                failed += 1
+    finally:
+        if jobs_file is not sys.stdin:
+            jobs_file.close()
+        if output is not sys.stdout:
+            output.close()
+    print(f"Solved {solved} job(s), {failed} failed", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
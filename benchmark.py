@@ -0,0 +1,576 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import threading
+import tracemalloc
+import multiprocessing
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import numpy as np
+from tsp_logic import HttpClient, TravelTimeCalculator, TourConstructor, TSPMethodFactory, TSPSolver
+
+# Benchmarks for the solving methods and for the requests to Nominatim and OpenRouteService.
+#   python benchmark.py solvers --suite quick --save-baseline
+#   python benchmark.py solvers --tsplib path/to/tsplib --methods TwoOpt IteratedLocalSearch --baseline
+#   python benchmark.py io --record --locations stops.txt --name europe   (needs API_KEY.txt, calls the real services)
+#   python benchmark.py io                                                (replays the recordings offline)
+#   python benchmark.py startup                                           (cold start and memory per method)
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmarks')
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+SUITES = {
+    'quick': {'kinds': ('euclidean', 'clustered', 'asymmetric'), 'sizes': (8, 15, 50, 100), 'seeds': (0,)},
+    'full': {'kinds': ('euclidean', 'clustered', 'asymmetric'), 'sizes': (8, 15, 30, 100, 200, 500), 'seeds': (0, 1, 2)},
+}
+DEFAULT_METHODS = ('TwoOpt', 'IteratedLocalSearch', 'Permutations', 'HeldKarp', 'FlowBased', 'FlowBasedDFJ', 'ConstraintProgramming')
+# Larger instances are skipped for these methods, they would only run into the time limit
+METHOD_MAX_CITIES = {'Permutations': 9, 'HeldKarp': 18, 'FlowBased': 30, 'FlowBasedDFJ': 200}
+
+# Optimal tour lengths of TSPLIB instances, used for the gap if the file is found
+TSPLIB_OPTIMA = {
+    'burma14': 3323, 'ulysses16': 6859, 'gr17': 2085, 'br17': 39, 'ulysses22': 7013, 'gr24': 1272, 'fri26': 937,
+    'bays29': 2020, 'ftv33': 1286, 'dantzig42': 699, 'swiss42': 1273, 'p43': 5620, 'att48': 10628, 'ry48p': 14422,
+    'eil51': 426, 'berlin52': 7542, 'ft53': 6905, 'st70': 675, 'eil76': 538, 'pr76': 108159, 'rat99': 1211,
+    'kroA100': 21282, 'ch150': 6528, 'a280': 2579,
+}
+
+
+class Instance:
+    def __init__(self, name, kind, distance_matrix, coordinates=None, optimum=None):
+        self.name = name
+        self.kind = kind
+        self.distance_matrix = distance_matrix
+        self.coordinates = coordinates
+        self.optimum = optimum  # Known optimal tour length, None if unknown
+
+    @property
+    def size(self):
+        return self.distance_matrix.shape[0]
+
+
+def euclidean_matrix(points):
+    return np.rint(np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1))).astype(np.int32)
+
+
+def random_euclidean(n, seed):
+    # Cities spread uniformly over a 10000 x 10000 square
+    points = np.random.default_rng(seed).random((n, 2)) * 10000
+    return Instance(f"euclidean-{n}-{seed}", 'euclidean', euclidean_matrix(points), points.tolist())
+
+
+def clustered(n, seed, num_clusters=None):
+    # Cities around a few centers, like stops in several towns
+    rng = np.random.default_rng(seed)
+    num_clusters = num_clusters or max(2, n // 20)
+    centers = rng.random((num_clusters, 2)) * 10000
+    points = centers[rng.integers(num_clusters, size=n)] + rng.normal(scale=300, size=(n, 2))
+    return Instance(f"clustered-{n}-{seed}", 'clustered', euclidean_matrix(points), points.tolist())
+
+
+def asymmetric(n, seed):
+    # Euclidean distances with each direction up to 30% longer, like one-way streets and slopes
+    rng = np.random.default_rng(seed)
+    points = rng.random((n, 2)) * 10000
+    matrix = np.rint(euclidean_matrix(points) * (1 + 0.3 * rng.random((n, n)))).astype(np.int32)
+    return Instance(f"asymmetric-{n}-{seed}", 'asymmetric', matrix, points.tolist())
+
+
+GENERATORS = {'euclidean': random_euclidean, 'clustered': clustered, 'asymmetric': asymmetric}
+
+
+def load_tsplib(path, optimum=None):
+    # Reads a TSPLIB .tsp/.atsp file with EUC_2D, CEIL_2D, ATT, GEO or EXPLICIT edge weights
+    header = {}
+    numbers = []
+    section = None
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line == 'EOF':
+                continue
+            if line.endswith('SECTION'):
+                section = line
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                header[key.strip()] = value.strip()
+                section = None
+            elif section in ('NODE_COORD_SECTION', 'EDGE_WEIGHT_SECTION'):
+                numbers.extend(float(value) for value in line.split())
+            # DISPLAY_DATA_SECTION and others are not needed
+
+    name = header.get('NAME', os.path.splitext(os.path.basename(path))[0])
+    n = int(header['DIMENSION'])
+    weight_type = header.get('EDGE_WEIGHT_TYPE', 'EUC_2D')
+    coordinates = None
+    if weight_type == 'EXPLICIT':
+        matrix = explicit_matrix(numbers, n, header.get('EDGE_WEIGHT_FORMAT', 'FULL_MATRIX'))
+    else:
+        points = np.array(numbers).reshape(n, 3)[:, 1:]
+        coordinates = points.tolist()
+        delta = points[:, None, :] - points[None, :, :]
+        if weight_type == 'EUC_2D':
+            matrix = np.floor(np.hypot(delta[..., 0], delta[..., 1]) + 0.5)
+        elif weight_type == 'CEIL_2D':
+            matrix = np.ceil(np.hypot(delta[..., 0], delta[..., 1]))
+        elif weight_type == 'ATT':
+            distance = np.sqrt((delta[..., 0] ** 2 + delta[..., 1] ** 2) / 10)
+            rounded = np.floor(distance + 0.5)
+            matrix = np.where(rounded < distance, rounded + 1, rounded)
+        elif weight_type == 'GEO':
+            # Degrees.minutes to radians as defined by TSPLIB
+            degrees = np.trunc(points)
+            radians = math.pi * (degrees + 5 * (points - degrees) / 3) / 180
+            latitude, longitude = radians[:, 0], radians[:, 1]
+            q1 = np.cos(longitude[:, None] - longitude[None, :])
+            q2 = np.cos(latitude[:, None] - latitude[None, :])
+            q3 = np.cos(latitude[:, None] + latitude[None, :])
+            matrix = np.floor(6378.388 * np.arccos(np.clip(0.5 * ((1 + q1) * q2 - (1 - q1) * q3), -1, 1)) + 1)
+            # GEO coordinates are latitude, longitude
+            coordinates = points[:, ::-1].tolist()
+        else:
+            raise ValueError(f"Unsupported EDGE_WEIGHT_TYPE: {weight_type}")
+        np.fill_diagonal(matrix, 0)
+    if optimum is None:
+        optimum = TSPLIB_OPTIMA.get(name)
+    return Instance(name, 'tsplib', matrix.astype(np.int32), coordinates, optimum)
+
+
+def explicit_matrix(numbers, n, weight_format):
+    if weight_format == 'FULL_MATRIX':
+        return np.array(numbers[:n * n]).reshape(n, n)
+    matrix = np.zeros((n, n))
+    values = iter(numbers)
+    rows = {
+        'UPPER_ROW': lambda i: range(i + 1, n),
+        'LOWER_ROW': lambda i: range(i),
+        'UPPER_DIAG_ROW': lambda i: range(i, n),
+        'LOWER_DIAG_ROW': lambda i: range(i + 1),
+    }
+    if weight_format not in rows:
+        raise ValueError(f"Unsupported EDGE_WEIGHT_FORMAT: {weight_format}")
+    for i in range(n):
+        for j in rows[weight_format](i):
+            matrix[i, j] = matrix[j, i] = next(values)
+    return matrix
+
+
+def tsplib_instances(directory):
+    instances = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith(('.tsp', '.atsp')):
+            instances.append(load_tsplib(os.path.join(directory, file_name)))
+    return instances
+
+
+def _run_method(connection, distance_matrix, coordinates, method_name, max_time_seconds):
+    # Runs in a fresh process, so that the peak memory belongs to this run only
+    tracemalloc.start()
+    start = time.perf_counter()
+    method = TSPMethodFactory.create_method(method_name, distance_matrix)
+    method.coordinates = coordinates
+    solver = TSPSolver(distance_matrix, method)
+    optimal, tour = solver.solve_tsp(max_time_seconds)
+    wall_seconds = time.perf_counter() - start
+    peak_python_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    peak_rss_mb = None
+    try:
+        import resource
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+    except ImportError:
+        pass
+    result = {'wall_seconds': wall_seconds, 'peak_python_mb': peak_python_mb, 'peak_rss_mb': peak_rss_mb, 'optimal': bool(optimal), 'cost': None}
+    if tour is not None:
+        quality = solver.quality(tour, optimal)
+        result.update(cost=quality['cost'], bound=quality['bound'])
+    connection.send(result)
+    connection.close()
+
+
+def run_solvers(instances, methods, max_time_seconds, grace_seconds=30):
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for instance in instances:
+        for method_name in methods:
+            if instance.size > METHOD_MAX_CITIES.get(method_name, instance.size):
+                continue
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_method, args=(sender, instance.distance_matrix, instance.coordinates, method_name, max_time_seconds))
+            process.start()
+            sender.close()
+            result = {'instance': instance.name, 'kind': instance.kind, 'size': instance.size, 'method': method_name}
+            if receiver.poll(max_time_seconds + grace_seconds):
+                try:
+                    result.update(receiver.recv())
+                except EOFError:
+                    result['error'] = f"crashed with exit code {process.exitcode}"
+            else:
+                process.terminate()
+                result['error'] = 'timeout'
+            process.join()
+
+            cost = result.get('cost')
+            if cost is not None:
+                reference = instance.optimum if instance.optimum is not None else result['bound']
+                result['optimum'] = instance.optimum
+                result['gap'] = (cost - reference) / cost if cost > 0 else 0.0
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    if 'error' in result:
+        print(f"{result['instance']:<22} {result['method']:<24} {result['error']}")
+        return
+    gap = 'n/a' if result.get('gap') is None else f"{result['gap']:.2%}"
+    reference = 'opt' if result.get('optimum') is not None else 'lb'
+    rss = 'n/a' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+    print(f"{result['instance']:<22} {result['method']:<24} {result['wall_seconds']:8.2f}s {result['peak_python_mb']:8.1f}MB py "
+          f"{rss:>6}MB rss  cost {result['cost']}  gap to {reference} {gap}{'  optimal' if result['optimal'] else ''}")
+
+
+def summarize(results):
+    # Mean time and gap per method and size
+    groups = {}
+    for result in results:
+        if result.get('cost') is not None:
+            groups.setdefault((result['method'], result['size']), []).append(result)
+    print(f"\n{'method':<24} {'size':>5} {'runs':>5} {'mean time':>10} {'mean gap':>9}")
+    for (method_name, size), group in sorted(groups.items()):
+        mean_time = sum(r['wall_seconds'] for r in group) / len(group)
+        mean_gap = sum(r['gap'] for r in group) / len(group)
+        print(f"{method_name:<24} {size:>5} {len(group):>5} {mean_time:>9.2f}s {mean_gap:>8.2%}")
+
+
+def compare(results, baseline, time_tolerance=0.25, cost_tolerance=0.01, memory_tolerance=0.25):
+    # Runs that got slower, worse or bigger than the baseline by more than the tolerance; small absolute
+    # differences are ignored since short runs are noisy
+    previous = {(r['instance'], r['method']): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['instance'], result['method']))
+        if before is None or before.get('cost') is None:
+            continue
+        if result.get('cost') is None:
+            regressions.append(f"{result['instance']} {result['method']}: {result.get('error', 'no tour')}")
+            continue
+        if result['wall_seconds'] > before['wall_seconds'] * (1 + time_tolerance) + 0.1:
+            regressions.append(f"{result['instance']} {result['method']}: time {before['wall_seconds']:.2f}s -> {result['wall_seconds']:.2f}s")
+        if result['cost'] > before['cost'] * (1 + cost_tolerance):
+            regressions.append(f"{result['instance']} {result['method']}: cost {before['cost']} -> {result['cost']}")
+        if result['peak_python_mb'] > before['peak_python_mb'] * (1 + memory_tolerance) + 1:
+            regressions.append(f"{result['instance']} {result['method']}: memory {before['peak_python_mb']:.1f}MB -> {result['peak_python_mb']:.1f}MB")
+    return regressions
+
+
+# I/O benchmark: the requests of a solve are recorded once from the real services and then replayed by a local
+# stand-in server, so the client side (pooling, batching, caching) can be measured offline and repeatably
+
+def endpoint(url):
+    parsed = urlparse(url)
+    if 'nominatim' in (parsed.hostname or ''):
+        return 'geocode'
+    if '/matrix/' in parsed.path:
+        return 'matrix'
+    if '/directions/' in parsed.path:
+        return 'directions'
+    return 'other'
+
+
+def request_key(method, url, body):
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return f"{method} {url} {body or ''}"
+
+
+class RecordingHttpClient(HttpClient):
+    # Calls the real services and keeps every response for replay
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.recordings = {}
+        self.last_latency = threading.local()
+
+    def _record(self, host, seconds):
+        # The latency of the request itself, without waiting for the rate limit
+        super()._record(host, seconds)
+        self.last_latency.seconds = seconds
+
+    def request(self, method, url, **kwargs):
+        response = super().request(method, url, **kwargs)
+        self.recordings[request_key(method, response.request.url, response.request.body)] = {
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type', 'application/json'),
+            'body': response.text,
+            'seconds': self.last_latency.seconds,
+        }
+        return response
+
+
+class StandInHttpClient(HttpClient):
+    # Sends every request to the local stand-in server instead of the service in the url,
+    # with rate_limited=True still as slowly as the rate limits of the real services allow
+    def __init__(self, address, rate_limited=False, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+        self.rate_limited = rate_limited
+
+    def request(self, method, url, **kwargs):
+        parsed = urlparse(url)
+        if self.rate_limited and parsed.hostname in self.rate_limiters:
+            self.rate_limiters[parsed.hostname].wait()
+        local_url = f"http://{self.address}/{parsed.hostname}{parsed.path}" + (f"?{parsed.query}" if parsed.query else '')
+        return super().request(method, local_url, **kwargs)
+
+
+class StandInServer:
+    # Serves recorded responses on localhost, optionally as slow as the real service was
+    def __init__(self, recordings, replay_latency=True):
+        self.recordings = recordings
+        self.replay_latency = replay_latency
+        self.lock = threading.Lock()
+        self.counts = {}
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                url = 'https://' + self.path[1:]
+                recording = stand_in.recordings.get(request_key(self.command, url, body or None))
+                stand_in.count(url, recording)
+                if recording is None:
+                    self.send_error(404, 'Not recorded')
+                    return
+                if stand_in.replay_latency:
+                    time.sleep(recording['seconds'])
+                payload = recording['body'].encode('utf-8')
+                self.send_response(recording['status'])
+                self.send_header('Content-Type', recording['content_type'])
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def count(self, url, recording):
+        with self.lock:
+            counts = self.counts.setdefault(endpoint(url), {'requests': 0, 'missing': 0, 'bytes': 0, 'service_seconds': 0.0})
+            counts['requests'] += 1
+            if recording is None:
+                counts['missing'] += 1
+            else:
+                counts['bytes'] += len(recording['body'])
+                counts['service_seconds'] += recording['seconds']
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_io_phases(calculator, locations, mode):
+    # The requests of a solve without cache: geocoding, the duration matrix and the route legs of a tour
+    phases = {}
+    start = time.perf_counter()
+    coordinates = calculator.get_coordinates(locations)
+    phases['geocode'] = time.perf_counter() - start
+    if coordinates is None:
+        return phases
+    start = time.perf_counter()
+    matrix = calculator.get_duration_matrix(coordinates, mode)
+    phases['matrix'] = time.perf_counter() - start
+    if matrix is None:
+        return phases
+    tour = TourConstructor.nearest_neighbor(matrix).tolist()
+    start = time.perf_counter()
+    calculator.get_tour_legs(coordinates, tour + [tour[0]], mode)
+    phases['directions'] = time.perf_counter() - start
+    return phases
+
+
+def record_io(name, locations, mode, API_KEY):
+    client = RecordingHttpClient()
+    phases = run_io_phases(TravelTimeCalculator(API_KEY, cache=None, http=client), locations, mode)
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_DIR, f"io_{name}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'locations': locations, 'mode': mode, 'responses': client.recordings}, f)
+    print(f"Recorded {len(client.recordings)} responses to {path}")
+    print_io(name, phases, None)
+
+
+def replay_io(replay_latency=True, rate_limited=False):
+    paths = [os.path.join(BENCHMARK_DIR, f) for f in sorted(os.listdir(BENCHMARK_DIR))] if os.path.isdir(BENCHMARK_DIR) else []
+    paths = [path for path in paths if os.path.basename(path).startswith('io_') and path.endswith('.json')]
+    if not paths:
+        print(f"No recordings in {BENCHMARK_DIR}, record some with: python benchmark.py io --record --locations FILE --name NAME")
+        return
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            scenario = json.load(f)
+        with StandInServer(scenario['responses'], replay_latency) as server:
+            calculator = TravelTimeCalculator('stand-in', cache=None, http=StandInHttpClient(server.address, rate_limited))
+            phases = run_io_phases(calculator, scenario['locations'], scenario['mode'])
+        print_io(os.path.basename(path)[3:-5], phases, server.counts)
+
+
+def print_io(name, phases, counts):
+    print(f"\n{name}")
+    for phase, seconds in phases.items():
+        line = f"  {phase:<11} {seconds:8.3f}s"
+        if counts is not None and phase in counts:
+            c = counts[phase]
+            line += f"  {c['requests']:4d} requests  {c['bytes'] / 1024:8.1f}kB  service {c['service_seconds']:.3f}s"
+            if c['missing']:
+                line += f"  {c['missing']} not recorded"
+        print(line)
+
+
+# Runs in a fresh interpreter per method: the time to import tsp_logic and to solve a small instance, the peak memory
+# of the process and the backends that ended up imported
+STARTUP_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+import tsp_logic
+import_seconds = time.perf_counter() - start
+method_name = sys.argv[1]
+if method_name:
+    import numpy as np
+    points = np.random.default_rng(0).uniform(0, 1000, (12, 2))
+    matrix = np.rint(np.linalg.norm(points[:, None] - points[None], axis=2)).astype(int)
+    sys.stdout = open(os.devnull, 'w')
+    tsp_logic.TSPSolver(matrix, tsp_logic.TSPMethodFactory.create_method(method_name, matrix)).solve_tsp(1)
+    sys.stdout = sys.__stdout__
+result = {'import_seconds': import_seconds, 'wall_seconds': time.perf_counter() - start, 'peak_rss_mb': None,
+          'backends': [name for name in ('scipy', 'ortools', 'folium', 'requests') if name in sys.modules]}
+try:
+    import resource
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+except ImportError:
+    pass
+print(json.dumps(result))
+"""
+
+
+def run_startup(methods, repeats=3):
+    # The fastest of a few runs, the first one may still read the modules from disk
+    directory = os.path.dirname(os.path.realpath(__file__))
+    results = []
+    for method_name in [''] + list(methods):
+        runs = []
+        for _ in range(repeats):
+            completed = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, method_name], cwd=directory,
+                                       capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(completed.stderr, file=sys.stderr)
+                break
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        result = {'method': method_name or '(import only)'}
+        if runs:
+            result.update(min(runs, key=lambda run: run['wall_seconds']))
+        else:
+            result['error'] = 'crashed'
+        results.append(result)
+        if 'error' in result:
+            print(f"{result['method']:<26} {result['error']}")
+            continue
+        rss = 'n/a' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+        print(f"{result['method']:<26} import {result['import_seconds']:6.3f}s  total {result['wall_seconds']:6.3f}s "
+              f"{rss:>6}MB rss  loaded: {', '.join(result['backends']) or '-'}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the TSP methods and the travel time requests")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    solvers = commands.add_parser('solvers', help="Time, memory and quality of the methods")
+    solvers.add_argument('--suite', choices=sorted(SUITES), default='quick', help="Synthetic instances to run")
+    solvers.add_argument('--tsplib', default=None, help="Directory with TSPLIB files, replaces the synthetic instances")
+    solvers.add_argument('--methods', nargs='+', default=list(DEFAULT_METHODS))
+    solvers.add_argument('--time-limit', type=float, default=5, help="max_time_seconds of every run")
+    solvers.add_argument('--output', default=None, help="Write all results to this JSON file")
+    solvers.add_argument('--save-baseline', nargs='?', const=BASELINE_PATH, default=None, help="Store the results as the baseline")
+    solvers.add_argument('--baseline', nargs='?', const=BASELINE_PATH, default=None, help="Compare with a stored baseline, exit code 1 on regressions")
+
+    io = commands.add_parser('io', help="Geocoding, matrix and directions requests against recorded responses")
+    io.add_argument('--record', action='store_true', help="Call the real services and store their responses")
+    io.add_argument('--locations', default=None, help="Text file with one location per line (for --record)")
+    io.add_argument('--name', default='default', help="Name of the recording")
+    io.add_argument('--mode', default='driving')
+    io.add_argument('--no-latency', action='store_true', help="Answer immediately instead of as slow as the recorded service")
+    io.add_argument('--rate-limits', action='store_true', help="Keep to the rate limits of the real services")
+
+    startup = commands.add_parser('startup', help="Import time and memory of a fresh process per method")
+    startup.add_argument('--methods', nargs='+', default=list(DEFAULT_METHODS) + ['ClusterDecomposition'])
+    startup.add_argument('--output', default=None, help="Write all results to this JSON file")
+    args = parser.parse_args()
+
+    if args.command == 'io':
+        if args.record:
+            if args.locations is None:
+                parser.error("--record needs --locations")
+            with open(args.locations, 'r', encoding='utf-8') as f:
+                locations = [line.strip() for line in f if line.strip()]
+            record_io(args.name, locations, args.mode, open('API_KEY.txt', 'r').read().strip())
+        else:
+            replay_io(not args.no_latency, args.rate_limits)
+        return
+
+    for method_name in args.methods:
+        if method_name not in TSPMethodFactory.method_names():
+            parser.error(f"Unknown method: {method_name}")
+    if args.command == 'startup':
+        results = run_startup(args.methods)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=1)
+        return
+    if args.tsplib:
+        instances = tsplib_instances(args.tsplib)
+    else:
+        suite = SUITES[args.suite]
+        instances = [GENERATORS[kind](n, seed) for kind in suite['kinds'] for n in suite['sizes'] for seed in suite['seeds']]
+    results = run_solvers(instances, args.methods, args.time_limit)
+    summarize(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,546 @@
 import requests
 import json
 import numpy as np
-from scipy.optimize import linear_sum_assignment
-import folium
 from itertools import permutations
-from ortools.linear_solver import pywraplp
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+from collections import deque
+from functools import partial
+from contextlib import contextmanager, nullcontext
 import time
+import cProfile
+import pstats
+import io
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import multiprocessing
+import os
+import sys
+import uuid
+import hashlib
+import importlib
+from importlib.metadata import entry_points
+from urllib.parse import urlparse
+# scipy, folium and OR-Tools are imported where they are used, so that a process only loads the backends of the
+# methods it runs (and folium only if it renders a map)
+
+class TravelCache:
+    # Disk backed cache for geocoding results, travel durations and route geometries.
+    # Entries expire after ttl_seconds and the least recently used ones are evicted once max_entries is exceeded.
+    # Durations are stored per pair, so the default keeps the full matrix of 1000 stops. set_many never evicts the
+    # entries it writes (nor those accessed since keep_since), so a larger matrix is still complete when fetched again.
+    def __init__(self, path='travel_cache.sqlite', ttl_seconds=30 * 24 * 3600, max_entries=1000000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (kind, key))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self.connection.commit()
+            # Counted once and then kept up to date by set_many, which counts every written entry as new. Only when
+            # this upper bound exceeds max_entries are the entries counted again (other processes write too)
+            self.count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def normalize_location(location):
+        return " ".join(location.lower().split())
+
+    @staticmethod
+    def coordinate_key(coordinate):
+        return f"{float(coordinate[0]):.6f},{float(coordinate[1]):.6f}"
+
+    @classmethod
+    def pair_key(cls, profile, origin, destination):
+        return f"{profile}|{cls.coordinate_key(origin)}|{cls.coordinate_key(destination)}"
+
+    def get(self, kind, key):
+        return self.get_many(kind, [key]).get(key)
+
+    def get_many(self, kind, keys):
+        found = {}
+        now = time.time()
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            # SQLite limits the number of host parameters per statement
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM entries WHERE kind = ? AND created >= ? AND key IN ({placeholders})",
+                    [kind, now - self.ttl_seconds, *chunk]
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = json.loads(value)
+                if rows:
+                    # Refresh the access time so recently used entries survive eviction
+                    self.connection.execute(
+                        f"UPDATE entries SET accessed = ? WHERE kind = ? AND key IN ({','.join('?' * len(rows))})",
+                        [now, kind, *[key for key, _ in rows]]
+                    )
+            self.connection.commit()
+            self.hits[kind] = self.hits.get(kind, 0) + len(found)
+            self.misses[kind] = self.misses.get(kind, 0) + len(unique_keys) - len(found)
+        return found
+
+    def set(self, kind, key, value):
+        self.set_many(kind, {key: value})
+
+    def set_many(self, kind, items, keep_since=None):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entries (kind, key, value, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                [(kind, key, json.dumps(value), now, now) for key, value in items.items()]
+            )
+            self.count += len(items)
+            if self.count > self.max_entries:
+                self._evict(now, now if keep_since is None else keep_since)
+            self.connection.commit()
+
+    def _evict(self, now, keep_since):
+        self.connection.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl_seconds,))
+        self.count = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if self.count > self.max_entries:
+            # Entries accessed since keep_since belong to the matrix that is being built, keep them even above the limit
+            deleted = self.connection.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries WHERE accessed < ? ORDER BY accessed LIMIT ?)",
+                (keep_since, self.count - self.max_entries)
+            ).rowcount
+            self.count -= deleted
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM entries")
+            self.connection.commit()
+            self.count = 0
+
+    def stats(self):
+        # Hit/miss counters per kind of entry ('geocode', 'duration', 'route')
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {kind: {'hits': self.hits.get(kind, 0), 'misses': self.misses.get(kind, 0)} for kind in kinds}
+
+class SolveCache:
+    # Results of earlier solves in the database of a TravelCache, keyed by a fingerprint of the matrix, the method, its
+    # parameters and the gap target. Each entry holds the closed tour, its cost and lower bound, whether it is optimal
+    # and how many seconds the method ran (all of its time limit unless it was cancelled or stopped at the gap target). The least recently used entries are evicted once they take more than max_bytes.
+    def __init__(self, cache, max_bytes=64 * 2 ** 20):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        with cache.lock:
+            cache.connection.execute(
+                "CREATE TABLE IF NOT EXISTS solves ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            cache.connection.execute("CREATE INDEX IF NOT EXISTS solves_accessed ON solves (accessed)")
+            cache.connection.commit()
+
+    @staticmethod
+    def fingerprint(distance_matrix, method_name, params=None, candidate_lists=None, gap_target=None):
+        digest = hashlib.sha256()
+        matrix = as_distance_matrix(distance_matrix)
+        digest.update(np.array(matrix.shape, dtype=np.int64).tobytes())
+        digest.update(matrix.tobytes())
+        if candidate_lists is not None:
+            digest.update(np.ascontiguousarray(candidate_lists, dtype=np.int64).tobytes())
+        digest.update(json.dumps([method_name, params or {}, gap_target], sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.cache.lock:
+            row = self.cache.connection.execute("SELECT value FROM solves WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.cache.connection.execute("UPDATE solves SET accessed = ? WHERE key = ?", (time.time(), key))
+                self.cache.connection.commit()
+            # Counted like the other kinds of entries, so the hits show up in TravelCache.stats()
+            counter = self.cache.hits if row is not None else self.cache.misses
+            counter['solve'] = counter.get('solve', 0) + 1
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key, result):
+        value = json.dumps(result)
+        with self.cache.lock:
+            self.cache.connection.execute(
+                "INSERT OR REPLACE INTO solves (key, value, size, accessed) VALUES (?, ?, ?, ?)", (key, value, len(value), time.time())
+            )
+            self._evict()
+            self.cache.connection.commit()
+
+    def _evict(self):
+        excess = self.cache.connection.execute("SELECT COALESCE(SUM(size), 0) FROM solves").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self.cache.connection.execute("SELECT key, size FROM solves ORDER BY accessed"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.cache.connection.executemany("DELETE FROM solves WHERE key = ?", evicted)
+
+    def clear(self):
+        with self.cache.lock:
+            self.cache.connection.execute("DELETE FROM solves")
+            self.cache.connection.commit()
+
+    @staticmethod
+    def is_final(result, max_time_seconds, gap_target=None):
+        # A stored result is returned as is if it is optimal, good enough for gap_target or if the method already had
+        # at least max_time_seconds; otherwise its tour only warm starts the new solve
+        return (result['optimal'] or max_time_seconds <= result['seconds']
+                or (gap_target is not None and result['cost'] > 0 and (result['cost'] - result['bound']) / result['cost'] <= gap_target))
+
+    @staticmethod
+    def quality(result):
+        cost, bound = result['cost'], result['bound']
+        return {'cost': cost, 'bound': bound, 'gap': (cost - bound) / cost if cost > 0 else 0.0}
+
+class RateLimiter:
+    # Spaces out calls so that at most requests_per_second are started, shared by all threads
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+class HttpClient:
+    # Shared I/O layer: pooled connections, per-host rate limits, retries with backoff and latency statistics
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate_limits=None, max_retries=4, backoff_seconds=1.0, timeout_seconds=30, max_workers=8):
+        if rate_limits is None:
+            rate_limits = {
+                'nominatim.openstreetmap.org': 1.0,  # Nominatim usage policy: at most 1 request per second
+                'api.openrouteservice.org': 40 / 60,  # Free OpenRouteService plan: 40 requests per minute
+            }
+        self.rate_limiters = {host: RateLimiter(rate) for host, rate in rate_limits.items()}
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.max_workers = max_workers
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'TSP_solver'  # Nominatim rejects requests without a User-Agent
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.profiler = None  # SolveProfiler of the running solve, if any
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        host = urlparse(url).hostname
+        limiter = self.rate_limiters.get(host)
+        for attempt in range(self.max_retries + 1):
+            if limiter is not None:
+                limiter.wait()
+            start_time = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout_seconds, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(host, time.perf_counter() - start_time)
+                if attempt == self.max_retries:
+                    raise
+                print(f"Request to {host} failed ({e}), retrying")
+                time.sleep(self.backoff_seconds * 2 ** attempt)
+                continue
+            seconds = time.perf_counter() - start_time
+            self._record(host, seconds)
+            if self.profiler is not None:
+                self.profiler.record_request(host, seconds, len(response.content))
+
+            if response.status_code in self.RETRY_STATUS_CODES and attempt < self.max_retries:
+                # Respect Retry-After if the service tells us how long to wait
+                retry_after = response.headers.get('Retry-After')
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff_seconds * 2 ** attempt
+                print(f"Request to {host} returned {response.status_code}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            return response
+
+    def map(self, function, items):
+        # Run function over items concurrently, results keep the order of items
+        return list(self.executor.map(function, items))
+
+    def _record(self, host, seconds):
+        with self.lock:
+            self.latencies.setdefault(host, []).append(seconds)
+
+    def stats(self):
+        # Number of requests and latency in seconds per host
+        with self.lock:
+            return {
+                host: {
+                    'requests': len(latencies),
+                    'total_seconds': sum(latencies),
+                    'mean_seconds': sum(latencies) / len(latencies),
+                    'max_seconds': max(latencies),
+                }
+                for host, latencies in self.latencies.items()
+            }
+
+class SolveProfiler:
+    # Timing report of one solve: phase spans, requests per host, the work done by the method and the size of its model.
+    # With profile=True the solve also runs under cProfile and the report lists the most expensive functions.
+    def __init__(self, profile=False):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.phases = []
+        self.requests = {}
+        self.method = None  # The TSPMethod whose counters and model size are reported
+        self.profile = cProfile.Profile() if profile else None
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases.append({'name': name, 'start': start - self.start_time, 'seconds': time.perf_counter() - start})
+
+    @contextmanager
+    def profiling(self):
+        if self.profile is None:
+            yield
+            return
+        self.profile.enable()
+        try:
+            yield
+        finally:
+            self.profile.disable()
+
+    def record_request(self, host, seconds, num_bytes):
+        with self.lock:
+            entry = self.requests.setdefault(host, {'requests': 0, 'bytes': 0, 'seconds': 0.0})
+            entry['requests'] += 1
+            entry['bytes'] += num_bytes
+            entry['seconds'] += seconds
+
+    def report(self, num_functions=20):
+        # A JSON serializable dict, so it can be passed between processes and written to logs
+        with self.lock:
+            # Repeated phases, e.g. the MIP searches between cuts, are summed up
+            phases = {}
+            for phase in self.phases:
+                total = phases.setdefault(phase['name'], {'name': phase['name'], 'start': phase['start'], 'seconds': 0.0, 'count': 0})
+                total['seconds'] += phase['seconds']
+                total['count'] += 1
+            report = {
+                'total_seconds': time.perf_counter() - self.start_time,
+                'phases': sorted(phases.values(), key=lambda phase: phase['start']),
+                'requests': {host: dict(entry) for host, entry in self.requests.items()},
+            }
+        if self.method is not None:
+            solve_seconds = sum(phase['seconds'] for phase in report['phases'] if phase['name'] == 'solve')
+            report['method'] = {
+                'name': type(self.method).__name__,
+                'counters': dict(self.method.counters),
+                'per_second': {name: value / solve_seconds for name, value in self.method.counters.items()} if solve_seconds > 0 else {},
+                'model_size': dict(self.method.model_size),
+            }
+        if self.profile is not None:
+            stream = io.StringIO()
+            pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(num_functions)
+            report['profile'] = stream.getvalue()
+        return report
+
+    @staticmethod
+    def format(report):
+        lines = [f"Total {report['total_seconds']:.3f}s"]
+        for phase in report['phases']:
+            lines.append(f"  {phase['name']:<16} {phase['seconds']:8.3f}s" + (f" ({phase['count']}x)" if phase['count'] > 1 else ""))
+        for host, entry in report['requests'].items():
+            lines.append(f"  {host}: {entry['requests']} request(s), {entry['bytes'] / 1024:.1f} kB, {entry['seconds']:.3f}s")
+        method = report.get('method')
+        if method is not None:
+            work = ", ".join(f"{value} {name} ({method['per_second'].get(name, 0):.0f}/s)" for name, value in method['counters'].items())
+            lines.append(f"  {method['name']}: {work or 'no counters'}")
+            if method['model_size']:
+                lines.append("  Model: " + ", ".join(f"{value} {name}" for name, value in method['model_size'].items()))
+        if 'profile' in report:
+            lines.append(report['profile'])
+        return "\n".join(lines)
+
+def profile_span(profiler, name):
+    # Times a phase if a SolveProfiler is attached, otherwise does nothing
+    return profiler.span(name) if profiler is not None else nullcontext()
+
+class CandidateDurations:
+    # Travel times of a route where only some pairs were requested: an estimate for every pair, the candidate
+    # neighbors of every stop and the real durations fetched so far (the candidate pairs and later the tour edges)
+    UNREACHABLE_PENALTY = 100  # Pairs without a route count as this many times their estimate
+
+    def __init__(self, estimate, candidates):
+        self.estimate = estimate
+        self.candidates = candidates  # (n, k) array, the k nearest stops of every stop by the estimate
+        self.known = {}  # (origin, destination) -> duration in seconds or TravelTimeCalculator.UNREACHABLE
+
+    def add(self, rows, cols, block):
+        for i, row in zip(rows, block):
+            for j, duration in zip(cols, row):
+                self.known[int(i), int(j)] = int(duration)
+
+    def missing(self, pairs):
+        return [(int(i), int(j)) for i, j in pairs if (int(i), int(j)) not in self.known and i != j]
+
+    def unreachable(self, pairs):
+        return [(int(i), int(j)) for i, j in pairs if self.known.get((int(i), int(j))) == TravelTimeCalculator.UNREACHABLE]
+
+    def matrix(self):
+        # Dense matrix for the methods: real durations where known, the estimate elsewhere
+        matrix = self.estimate.copy()
+        if self.known:
+            pairs = np.array(list(self.known.keys()))
+            durations = np.array(list(self.known.values()))
+            unreachable = durations == TravelTimeCalculator.UNREACHABLE
+            durations[unreachable] = self.estimate[pairs[unreachable, 0], pairs[unreachable, 1]] * self.UNREACHABLE_PENALTY
+            matrix[pairs[:, 0], pairs[:, 1]] = durations
+        return matrix
+
+    def known_fraction(self):
+        n = self.estimate.shape[0]
+        return len(self.known) / max(n * (n - 1), 1)
+
+class RouteGeometry:
+    # The road geometry of a tour as one (m, 2) array of (lat, lon) points and the index where every leg starts.
+    # Every point gets the first zoom level at which it is visible: Douglas-Peucker on the Web Mercator projection
+    # with a tolerance of one pixel of that zoom. One simplification then serves every zoom level, and only the
+    # points visible at MAX_ZOOM are kept and shipped to the map (as an encoded polyline).
+    MAX_ZOOM = 16  # Points that do not move the line by a pixel at this zoom are dropped
+    PRECISION = 5  # Decimal places of the encoded polyline
+
+    def __init__(self, legs):
+        # legs are lists of (lon, lat) points as returned by OpenRouteService, every leg starts where the previous one ends
+        parts = [np.asarray(leg, dtype=float)[:, :2] for leg in legs]
+        parts = [parts[0]] + [part[1:] for part in parts[1:]]
+        self.points = np.concatenate(parts)[:, ::-1].copy()
+        self.leg_starts = np.concatenate(([0], np.cumsum([len(part) for part in parts])[:-1] - 1))
+        self.zooms = self._visible_zooms()
+        # Only the visible points are kept, which keeps the geometry small when it is sent between processes
+        kept = self.zooms <= self.MAX_ZOOM
+        self.leg_starts = np.cumsum(kept)[self.leg_starts] - 1
+        self.points = self.points[kept]
+        self.zooms = self.zooms[kept]
+
+    def _mercator(self):
+        # Pixel coordinates at zoom 0 (a 256 pixel world), one pixel at zoom z is 2^-z of these units
+        lat = np.radians(np.clip(self.points[:, 0], -85.0511, 85.0511))
+        x = (self.points[:, 1] + 180) / 360 * 256
+        y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * 256
+        return np.column_stack((x, y))
+
+    def _visible_zooms(self):
+        # Douglas-Peucker on all segments at once: every round splits each segment at its farthest point, until
+        # no point of a segment is a pixel away from it at MAX_ZOOM
+        xy = self._mercator()
+        tolerance = 2.0 ** -self.MAX_ZOOM
+        importance = np.zeros(len(xy))
+        # The stops are always visible, so every leg is simplified on its own
+        anchors = np.unique(np.append(self.leg_starts, len(xy) - 1))
+        importance[anchors] = np.inf
+        undecided = np.ones(len(xy), dtype=bool)
+        undecided[anchors] = False
+        while undecided.any():
+            points = np.flatnonzero(undecided)
+            segment = np.searchsorted(anchors, points)
+            start, end = anchors[segment - 1], anchors[segment]
+            distances = self._segment_distances(xy[points], xy[start], xy[end])
+            # The points of a segment are consecutive, so the maximum of every segment is a reduceat
+            first = np.flatnonzero(np.diff(segment, prepend=-1))
+            maxima = np.maximum.reduceat(distances, first)
+            group = np.cumsum(np.diff(segment, prepend=segment[0]) != 0)
+            # The first point of every segment at its maximum is where the segment is split
+            is_max = distances == maxima[group]
+            _, farthest = np.unique(group[is_max], return_index=True)
+            farthest = np.flatnonzero(is_max)[farthest]
+            # Nothing in between is visible at MAX_ZOOM, so those points are dropped
+            flat = maxima <= tolerance
+            undecided[points[flat[group]]] = False
+            # A point is never visible before the points of the segment it splits
+            split = farthest[~flat]
+            middle = points[split]
+            importance[middle] = np.minimum(distances[split], np.minimum(importance[start[split]], importance[end[split]]))
+            undecided[middle] = False
+            anchors = np.union1d(anchors, middle)
+
+        zooms = np.full(len(xy), self.MAX_ZOOM + 1, dtype=np.int8)  # MAX_ZOOM + 1 means dropped
+        kept = importance > tolerance
+        zooms[kept] = np.clip(np.floor(-np.log2(importance[kept])) + 1, 0, self.MAX_ZOOM)
+        return zooms
+
+    @staticmethod
+    def _segment_distances(points, start, end):
+        # Distance of every point to the segment from its start to its end (all arrays of shape (m, 2))
+        direction = end - start
+        length = np.einsum('ij,ij->i', direction, direction)
+        t = np.einsum('ij,ij->i', points - start, direction) / np.where(length > 0, length, 1)
+        offset = points - start - np.clip(t, 0, 1)[:, None] * direction
+        return np.hypot(offset[:, 0], offset[:, 1])
+
+    def positions(self, zoom=None):
+        # [lat, lon] of the points visible at zoom (MAX_ZOOM by default)
+        zoom = self.MAX_ZOOM if zoom is None else zoom
+        return np.round(self.points[self.zooms <= zoom], self.PRECISION).tolist()
+
+    def stop_positions(self):
+        return self.points[self.leg_starts].tolist()
+
+    def bounds(self):
+        return [self.points.min(axis=0).tolist(), self.points.max(axis=0).tolist()]
+
+    def encoded(self):
+        # The visible points as an encoded polyline and their zoom levels as one character each (chr(63 + zoom)),
+        # the browser decodes both and draws the points whose level is at most its zoom
+        return {'points': self.encode(self.points, self.PRECISION),
+                'zooms': ''.join(chr(63 + int(zoom)) for zoom in self.zooms)}
+
+    @staticmethod
+    def encode(points, precision=5):
+        # Google's encoded polyline format: rounded deltas, zigzag encoded, in chunks of 5 bits
+        values = np.round(np.asarray(points) * 10 ** precision).astype(np.int64)
+        deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+        chunks = []
+        for value in ((deltas << 1) ^ (deltas >> 63)).tolist():
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        return ''.join(chunks)
 
 class TravelTimeCalculator:
-    def __init__(self, API_KEY):
+    UNREACHABLE = -1  # Marks pairs without a route in the duration matrix
+    # For estimates without a request: average speed in km/h and how much longer roads are than the great circle
+    estimated_speeds = {"driving": 50, "walking": 5, "cycling": 16}
+    detour_factor = 1.3
+
+    def __init__(self, API_KEY, cache=None, http=None):
         self.API_KEY = API_KEY
+        self.cache = cache
+        self.http = http if http is not None else HttpClient()
+        self.profiler = None  # SolveProfiler of the running solve, if any
         self.mode_mapping = {
             "driving": "driving-car",
             "walking": "foot-walking",
@@ -19,34 +548,169 @@ class TravelTimeCalculator:
             #"transit": "transit"  # Did not find a way to make it work
         }
 
-    def get_travel_time(self, locations, mode):
-        # Use the OpenStreetMap API to get the coordinates of the locations
-        coordinates = []
-        for location in locations:
-            response = requests.get(f"http://nominatim.openstreetmap.org/search?q={location}&format=json")
-            coordinates.append((json.loads(response.text)[0]['lon'], json.loads(response.text)[0]['lat']))
-
-        # Use the OpenRouteService Matrix API to get the travel times between the locations
-        headers = {
+    def _headers(self):
+        return {
             'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
             'Authorization': self.API_KEY,
             'Content-Type': 'application/json; charset=utf-8'
         }
+
+    def geocode(self, location):
+        # Returns (lon, lat) of the location or None if OpenStreetMap doesn't know it
+        key = TravelCache.normalize_location(location)
+        if self.cache is not None:
+            cached = self.cache.get('geocode', key)
+            if cached is not None:
+                return tuple(cached)
+
+        response = self.http.get("https://nominatim.openstreetmap.org/search", params={'q': location, 'format': 'json'})
+        results = json.loads(response.text)
+        if not results:
+            return None
+        coordinates = (float(results[0]['lon']), float(results[0]['lat']))
+
+        if self.cache is not None:
+            self.cache.set('geocode', key, coordinates)
+        return coordinates
+
+    def get_coordinates(self, locations):
+        # Use the OpenStreetMap API to get the coordinates of the locations
+        coordinates = self.http.map(self.geocode, locations)
+        for location, location_coordinates in zip(locations, coordinates):
+            if location_coordinates is None:
+                print(f"No results found for location: {location}")
+                return None
+        return coordinates
+
+    def get_travel_time(self, locations, mode):
+        coordinates = self.get_coordinates(locations)
+        if coordinates is None:
+            return None
+        return self.get_duration_matrix(coordinates, mode)
+
+    def get_duration_matrix(self, coordinates, mode, tile_size=50, max_tile_attempts=3):
+        # Builds the int32 matrix of travel times in seconds from source/destination tiles, so the number of
+        # stops isn't capped by the element limit of a single OpenRouteService matrix request (3500 on the free plan).
+        # Pairs without a route are marked with UNREACHABLE.
+        indices = list(range(len(coordinates)))
+        return self.get_duration_block(coordinates, mode, indices, indices, tile_size, max_tile_attempts)
+
+    def get_duration_block(self, coordinates, mode, sources, destinations, tile_size=50, max_tile_attempts=3):
+        # Travel times from the coordinates at the indices in sources to those in destinations,
+        # as an int32 array of shape (len(sources), len(destinations)). Every request covers at most tile_size ** 2
+        # pairs, a block with few sources (or destinations) is fetched in correspondingly wider (or taller) tiles
+        profile = self.mode_mapping[mode]
+        row_size = max(1, min(len(sources), max(tile_size, tile_size ** 2 // max(len(destinations), 1))))
+        col_size = max(1, tile_size ** 2 // row_size)
+        keys = [[TravelCache.pair_key(profile, coordinates[i], coordinates[j]) for j in destinations] for i in sources]
+        matrix = np.full((len(sources), len(destinations)), self.UNREACHABLE, dtype=np.int32)
+
+        cached = {}
+        lookup_time = time.time()
+        if self.cache is not None:
+            cached = self.cache.get_many('duration', [key for row in keys for key in row])
+
+        # Tiles where every pair is cached already don't need a request
+        pending = []
+        for row_start in range(0, len(sources), row_size):
+            for col_start in range(0, len(destinations), col_size):
+                rows = range(row_start, min(row_start + row_size, len(sources)))
+                cols = range(col_start, min(col_start + col_size, len(destinations)))
+                if all(keys[i][j] in cached for i in rows for j in cols):
+                    matrix[row_start:rows.stop, col_start:cols.stop] = [[round(cached[keys[i][j]]) for j in cols] for i in rows]
+                else:
+                    pending.append((rows, cols))
+
+        # Fetch the tiles concurrently, tiles that failed are retried on their own
+        new_durations = {}
+        for attempt in range(max_tile_attempts):
+            if not pending:
+                break
+            results = self.http.map(
+                lambda tile: self._get_matrix_tile(coordinates, [sources[i] for i in tile[0]], [destinations[j] for j in tile[1]], profile),
+                pending
+            )
+            failed = []
+            for (rows, cols), durations in zip(pending, results):
+                if durations is None:
+                    failed.append((rows, cols))
+                    continue
+                for i, row in zip(rows, durations):
+                    for j, duration in zip(cols, row):
+                        if duration is not None:
+                            matrix[i, j] = round(duration)
+                            new_durations[keys[i][j]] = duration
+            pending = failed
+
+        # Only remember pairs that could actually be routed
+        if self.cache is not None and new_durations:
+            self.cache.set_many('duration', new_durations, keep_since=lookup_time)
+
+        if pending:
+            print(f"Error: {len(pending)} matrix tile(s) could not be fetched")
+            return None
+        return matrix
+
+    def estimate_duration_matrix(self, coordinates, mode):
+        # Travel times in seconds from the great circle distances, without any request
+        points = np.radians(np.asarray(coordinates, dtype=float))
+        lon, lat = points[:, 0], points[:, 1]
+        a = (np.sin((lat[:, None] - lat[None, :]) / 2) ** 2
+             + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin((lon[:, None] - lon[None, :]) / 2) ** 2)
+        kilometers = 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        return np.rint(kilometers * self.detour_factor / self.estimated_speeds[mode] * 3600).astype(np.int32)
+
+    def get_candidate_durations(self, coordinates, mode, num_candidates=10, tile_size=50):
+        # Fetches only the durations from every stop to its num_candidates nearest stops (by the estimate) instead of
+        # the whole matrix. Stops are grouped in the order of a space filling curve, so the stops of a group share
+        # most of their candidates and every group needs only a few tiles.
+        estimate = self.estimate_duration_matrix(coordinates, mode)
+        n = len(coordinates)
+        k = min(num_candidates, n - 1)
+        cost = estimate.astype(float)
+        np.fill_diagonal(cost, np.inf)
+        candidates = np.argpartition(cost, k - 1, axis=1)[:, :k]
+        durations = CandidateDurations(estimate, candidates)
+
+        order = TourConstructor.space_filling_curve(estimate, coordinates)
+        for start in range(0, n, tile_size):
+            rows = order[start:start + tile_size].tolist()
+            cols = np.unique(candidates[rows]).tolist()
+            block = self.get_duration_block(coordinates, mode, rows, cols, tile_size)
+            if block is None:
+                return None
+            durations.add(rows, cols, block)
+        return durations
+
+    def fetch_pairs(self, coordinates, mode, durations, pairs):
+        # Adds the real durations of the given (origin, destination) pairs to durations, returns False on failure
+        if not pairs:
+            return True
+        rows = sorted({i for i, j in pairs})
+        cols = sorted({j for i, j in pairs})
+        block = self.get_duration_block(coordinates, mode, rows, cols)
+        if block is None:
+            return False
+        durations.add(rows, cols, block)
+        return True
+
+    def _get_matrix_tile(self, coordinates, rows, cols, profile):
+        # Send every coordinate of the tile once and select the block with sources/destinations
+        indices = list(dict.fromkeys([*rows, *cols]))
+        position = {index: k for k, index in enumerate(indices)}
         body = {
-            'locations': coordinates,
-            'profile': self.mode_mapping[mode],
+            'locations': [list(coordinates[i]) for i in indices],
+            'sources': [position[i] for i in rows],
+            'destinations': [position[j] for j in cols],
+            'profile': profile,
             'metrics': ['duration']
         }
 
-        matrix_response = requests.post(f'https://api.openrouteservice.org/v2/matrix/{self.mode_mapping[mode]}', headers=headers, data=json.dumps(body))
+        matrix_response = self.http.post(f'https://api.openrouteservice.org/v2/matrix/{profile}', headers=self._headers(), data=json.dumps(body))
 
         # Check if the request was successful
         if matrix_response.status_code == 200:
-            # Extract the travel times from the response
-            travel_times = json.loads(matrix_response.text)['durations']
-
-            # Return the matrix of travel times
-            return travel_times
+            return json.loads(matrix_response.text)['durations']
         else:
             print(f"Error: {matrix_response.status_code}")
             print(matrix_response.text)
@@ -54,76 +718,152 @@ class TravelTimeCalculator:
 
     def get_route(self, origin, destination, mode):
         # Use the OpenStreetMap API to get the coordinates of the origin and destination
-        origin_response = requests.get(f"http://nominatim.openstreetmap.org/search?q={origin}&format=json")
-        destination_response = requests.get(f"http://nominatim.openstreetmap.org/search?q={destination}&format=json")
+        origin_coordinates = self.geocode(origin)
+        destination_coordinates = self.geocode(destination)
 
         # Check if the API returned results for the origin and destination
-        origin_coordinates = json.loads(origin_response.text)
-        destination_coordinates = json.loads(destination_response.text)
-        if not origin_coordinates or not destination_coordinates:
+        if origin_coordinates is None or destination_coordinates is None:
             print(f"No results found for origin: {origin} or destination: {destination}")
             print(f"Impossible Route: {origin} -> {destination}")
             return None
 
+        route = self.get_route_geometry(origin_coordinates, destination_coordinates, mode)
+        if route is None:
+            print(f"Error: no route geometry for origin: {origin} and destination: {destination}")
+        return route
+
+    def get_route_geometry(self, origin_coordinates, destination_coordinates, mode):
+        profile = self.mode_mapping[mode]
+        key = TravelCache.pair_key(profile, origin_coordinates, destination_coordinates)
+        if self.cache is not None:
+            cached = self.cache.get('route', key)
+            if cached is not None:
+                return cached
+
         # Use the OpenRouteService API to get the route between the origin and destination
-        headers = {
-            'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
-            'Authorization': self.API_KEY,
-            'Content-Type': 'application/json; charset=utf-8'
-        }
         body = {
-            'coordinates': [
-                [origin_coordinates[0]['lon'], origin_coordinates[0]['lat']],
-                [destination_coordinates[0]['lon'], destination_coordinates[0]['lat']]
-            ],
-            'profile': self.mode_mapping[mode],
+            'coordinates': [list(origin_coordinates), list(destination_coordinates)],
+            'profile': profile,
             'format': 'geojson'
         }
 
-        route_response = requests.post(f'https://api.openrouteservice.org/v2/directions/{self.mode_mapping[mode]}/geojson', headers=headers, data=json.dumps(body))
+        route_response = self.http.post(f'https://api.openrouteservice.org/v2/directions/{profile}/geojson', headers=self._headers(), data=json.dumps(body))
 
         # Check if the 'features' key exists in the response
         route_data = json.loads(route_response.text)
         if 'features' not in route_data:
-            print(f"Error: 'features' key not found in the route response for origin: {origin} and destination: {destination}")
+            print("Error: 'features' key not found in the route response")
             print("Response content:", route_response.text)
             return None
 
         # Extract the route from the response
         route = route_data['features'][0]['geometry']['coordinates']
 
+        if self.cache is not None:
+            self.cache.set('route', key, route)
         return route
 
-    def visualize_tsp_tour(self, locations, tour, mode, total_duration, ordered_locations):
-        all_cordinates_of_route = []
+    def get_tour_legs(self, coordinates, tour, mode, max_waypoints=50):
+        # Route geometries for every leg of the closed tour, fetched in as few multi-waypoint
+        # directions requests as possible (OpenRouteService allows at most 50 waypoints per request)
+        stops = list(tour)
+        if stops[0] != stops[-1]:
+            stops.append(stops[0])
+        profile = self.mode_mapping[mode]
+        pairs = [(coordinates[stops[i]], coordinates[stops[i + 1]]) for i in range(len(stops) - 1)]
+        keys = [TravelCache.pair_key(profile, origin, destination) for origin, destination in pairs]
+
+        legs = [None] * len(pairs)
+        if self.cache is not None:
+            cached = self.cache.get_many('route', keys)
+            legs = [cached.get(key) for key in keys]
+
+        # Group the missing legs into consecutive runs that fit into a single request
+        runs = []
+        for i, leg in enumerate(legs):
+            if leg is not None:
+                continue
+            if runs and runs[-1][-1] == i - 1 and len(runs[-1]) < max_waypoints - 1:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+
+        # The runs are independent, so they are requested concurrently
+        all_run_legs = self.http.map(
+            lambda run: self.get_multi_waypoint_route([pairs[i][0] for i in run] + [pairs[run[-1]][1]], mode),
+            runs
+        )
+        for run, run_legs in zip(runs, all_run_legs):
+            if run_legs is None:
+                return None
+            for i, leg in zip(run, run_legs):
+                legs[i] = leg
+            if self.cache is not None:
+                self.cache.set_many('route', {keys[i]: leg for i, leg in zip(run, run_legs)})
 
-        m = folium.Map(zoom_start=2)
+        return legs
 
-        for i in range(len(tour) - 1):
-            route = self.get_route(locations[tour[i]], locations[tour[i+1]], mode)
-            if route is None:
-                print(f"Impossible Route: {locations[tour[i]]} -> {locations[tour[i+1]]}")
-                return None
-            route = [(p[1], p[0]) for p in route]
-            all_cordinates_of_route.extend(route)
+    def get_multi_waypoint_route(self, waypoints, mode):
+        # One directions request through all waypoints, split back into one geometry per leg
+        profile = self.mode_mapping[mode]
+        body = {
+            'coordinates': [list(waypoint) for waypoint in waypoints],
+            'profile': profile,
+            'format': 'geojson'
+        }
 
-            folium.Marker(location=route[0], popup=locations[tour[i]]).add_to(m)
-            folium.PolyLine(route, color="red", weight=2.5, opacity=1).add_to(m)
+        route_response = self.http.post(f'https://api.openrouteservice.org/v2/directions/{profile}/geojson', headers=self._headers(), data=json.dumps(body))
 
-        route = [(p[1], p[0]) for p in self.get_route(locations[tour[-1]], locations[tour[0]], mode)]
-        if route is None:
-            print(f"Impossible Route: {locations[tour[-1]]} -> {locations[tour[0]]}")
+        route_data = json.loads(route_response.text)
+        if 'features' not in route_data:
+            print("Error: 'features' key not found in the route response")
+            print("Response content:", route_response.text)
             return None
-        
-        folium.Marker(location=route[0], popup=locations[tour[-1]]).add_to(m)
-        folium.PolyLine(route, color="red", weight=2.5, opacity=1).add_to(m)
 
-        avg_lat = sum(p[0] for p in all_cordinates_of_route) / len(all_cordinates_of_route)
-        avg_lon = sum(p[1] for p in all_cordinates_of_route) / len(all_cordinates_of_route)
-        m.location = [avg_lat, avg_lon]
+        feature = route_data['features'][0]
+        geometry = feature['geometry']['coordinates']
+        # way_points holds the index of every waypoint inside the geometry
+        way_points = feature['properties']['way_points']
+        return [geometry[way_points[k]:way_points[k + 1] + 1] for k in range(len(way_points) - 1)]
+
+    def visualize_tsp_tour(self, locations, tour, mode, total_duration, ordered_locations, coordinates=None, html_path='temp_route_visualization.html'):
+        import folium
+        m = folium.Map(zoom_start=2)
 
-        m.fit_bounds([[min(p[0] for p in all_cordinates_of_route), min(p[1] for p in all_cordinates_of_route)], 
-                    [max(p[0] for p in all_cordinates_of_route), max(p[1] for p in all_cordinates_of_route)]])
+        stops = list(tour)
+        if stops[0] != stops[-1]:
+            stops.append(stops[0])
+
+        with profile_span(self.profiler, 'route geometry'):
+            if coordinates is not None:
+                # Reuse the coordinates from the matrix request and fetch the whole tour in batched requests
+                legs = self.get_tour_legs(coordinates, stops, mode)
+                if legs is None:
+                    print("Impossible Route: " + " -> ".join(locations[i] for i in stops))
+                    return None
+            else:
+                legs = []
+                for i in range(len(stops) - 1):
+                    route = self.get_route(locations[stops[i]], locations[stops[i+1]], mode)
+                    if route is None:
+                        print(f"Impossible Route: {locations[stops[i]]} -> {locations[stops[i+1]]}")
+                        return None
+                    legs.append(route)
+
+        with profile_span(self.profiler, 'map rendering'):
+            return self._render_map(m, locations, stops, legs, total_duration, ordered_locations, html_path)
+
+    def _render_map(self, m, locations, stops, legs, total_duration, ordered_locations, html_path):
+        import folium
+        geometry = RouteGeometry(legs)
+
+        for i, position in enumerate(geometry.stop_positions()):
+            folium.Marker(location=position, popup=locations[stops[i]]).add_to(m)
+        # One simplified line instead of every raw point of every leg keeps the html small
+        folium.PolyLine(geometry.positions(), color="red", weight=2.5, opacity=1).add_to(m)
+
+        m.location = geometry.points.mean(axis=0).tolist()
+        m.fit_bounds(geometry.bounds())
 
         # Information box on the left
         hours = int(round(total_duration // 60))
@@ -149,61 +889,789 @@ class TravelTimeCalculator:
 
         final_html = '<meta charset="UTF-8">' + info_html + map_html
 
-        with open('temp_route_visualization.html', 'w', encoding='utf-8') as f:
+        with open(html_path, 'w', encoding='utf-8') as f:
             f.write(final_html)
 
-        return all_cordinates_of_route
+        return geometry
+
+def find_subtours(successor):
+    # Splits a successor array (successor[i] is the city visited after i) into its cycles
+    seen = np.zeros(len(successor), dtype=bool)
+    subtours = []
+    for start in range(len(successor)):
+        if seen[start]:
+            continue
+        cycle = []
+        city = start
+        while not seen[city]:
+            seen[city] = True
+            cycle.append(city)
+            city = successor[city]
+        subtours.append(cycle)
+    return subtours
+
+def patch_subtours(distance_matrix, subtours):
+    # Merges cycles into a single tour: the smallest cycle is repeatedly spliced into the cycle where
+    # exchanging one edge of each costs least. Orientation is preserved, so this is valid for asymmetric costs.
+    d = distance_matrix
+    cycles = [list(cycle) for cycle in subtours]
+    while len(cycles) > 1:
+        cycles.sort(key=len)
+        small = np.array(cycles.pop(0))
+        small_next = np.roll(small, -1)
+        others = np.concatenate([cycle for cycle in cycles])
+        others_next = np.concatenate([np.roll(cycle, -1) for cycle in cycles])
+        owner = np.repeat(np.arange(len(cycles)), [len(cycle) for cycle in cycles])
+        offset = np.concatenate([np.arange(len(cycle)) for cycle in cycles])
+        # Remove (a, a_next) from another cycle and (b, b_next) from the small one, add (a, b_next) and (b, a_next)
+        delta = (d[others[:, None], small_next[None, :]] + d[small[None, :], others_next[:, None]]
+                 - d[others, others_next][:, None] - d[small, small_next][None, :])
+        a, b = np.unravel_index(np.argmin(delta), delta.shape)
+        target = cycles[owner[a]]
+        i = offset[a]
+        k = (b + 1) % len(small)
+        cycles[owner[a]] = target[:i + 1] + small[k:].tolist() + small[:k].tolist() + target[i + 1:]
+    return cycles[0]
+
+class TourConstructor:
+    # Initial tours for the local search methods. Every constructor takes the cost matrix and optional (lon, lat)
+    # coordinates and returns an open tour (every city once) as a NumPy array, in O(n^2) or better unless noted.
+    names = ("nearest_neighbor", "greedy_edge", "cheapest_insertion", "farthest_insertion", "space_filling_curve", "assignment_patching")
+
+    @classmethod
+    def construct(cls, name, distance_matrix, coordinates=None):
+        if name not in cls.names:
+            raise ValueError(f"Unknown constructor: {name}")
+        return getattr(cls, name)(np.asarray(distance_matrix), coordinates)
+
+    @staticmethod
+    def nearest_neighbor(distance_matrix, coordinates=None, start=0):
+        # Always drive to the closest city not visited yet
+        n = distance_matrix.shape[0]
+        visited = np.zeros(n, dtype=bool)
+        tour = np.empty(n, dtype=int)
+        current = start
+        for k in range(n):
+            tour[k] = current
+            visited[current] = True
+            if k < n - 1:
+                current = int(np.argmin(np.where(visited, np.inf, distance_matrix[current])))
+        return tour
+
+    @staticmethod
+    def greedy_edge(distance_matrix, coordinates=None, num_neighbors=10):
+        # Adds the cheapest arcs among the nearest neighbors as long as every city keeps at most one successor and
+        # predecessor and no cycle closes, then chains the resulting paths with nearest neighbor jumps
+        n = distance_matrix.shape[0]
+        if n <= 3:
+            return np.arange(n)
+        k = min(num_neighbors, n - 1)
+        cost = distance_matrix.astype(float)
+        np.fill_diagonal(cost, np.inf)
+        origins = np.repeat(np.arange(n), k)
+        targets = np.argpartition(cost, k - 1, axis=1)[:, :k].ravel()
+        order = np.argsort(cost[origins, targets], kind='stable')
+
+        successor = np.full(n, -1)
+        predecessor = np.full(n, -1)
+        fragment = np.arange(n)  # union-find parents of the paths
+
+        def find(city):
+            while fragment[city] != city:
+                fragment[city] = fragment[fragment[city]]
+                city = fragment[city]
+            return city
+
+        added = 0
+        for a, b in zip(origins[order], targets[order]):
+            if successor[a] != -1 or predecessor[b] != -1:
+                continue
+            root_a, root_b = find(a), find(b)
+            if root_a == root_b:
+                continue
+            successor[a], predecessor[b] = b, a
+            fragment[root_a] = root_b
+            added += 1
+            if added == n - 1:
+                break
+
+        # Walk along the paths, jumping from each path end to the closest start of another path
+        heads = np.flatnonzero(predecessor == -1)
+        unused = np.ones(n, dtype=bool)
+        tour = []
+        head = heads[0]
+        while True:
+            city = head
+            while city != -1:
+                tour.append(city)
+                city = successor[city]
+            unused[head] = False
+            remaining = heads[unused[heads]]
+            if len(remaining) == 0:
+                break
+            head = remaining[np.argmin(distance_matrix[tour[-1], remaining])]
+        return np.array(tour)
+
+    @staticmethod
+    def cheapest_insertion(distance_matrix, coordinates=None):
+        # Grows a cycle by always inserting the city that increases its length least
+        d = distance_matrix
+        n = d.shape[0]
+        if n <= 3:
+            return np.arange(n)
+        successor = np.full(n, -1)
+        # Start with the cheapest round trip between two cities
+        pair_cost = (d + d.T).astype(float)
+        np.fill_diagonal(pair_cost, np.inf)
+        a, b = np.unravel_index(np.argmin(pair_cost), pair_cost.shape)
+        successor[a], successor[b] = b, a
+        in_tour = np.zeros(n, dtype=bool)
+        in_tour[[a, b]] = True
+
+        # best_after[x]: insert x after this city, best_cost[x]: cost of doing so
+        best_after = np.full(n, a)
+        best_cost = (d[a, :] + d[:, b] - d[a, b]).astype(float)
+        alternative = d[b, :] + d[:, a] - d[b, a]
+        best_after[alternative < best_cost] = b
+        best_cost = np.minimum(best_cost, alternative)
+        best_cost[in_tour] = np.inf
+
+        for _ in range(n - 2):
+            x = int(np.argmin(best_cost))
+            a = best_after[x]
+            b = successor[a]
+            successor[a], successor[x] = x, b
+            in_tour[x] = True
+            best_cost[x] = np.inf
+
+            # The edge (a, b) is gone, cities that wanted it look again over the whole cycle
+            stale = np.flatnonzero((best_after == a) & ~in_tour)
+            if len(stale):
+                cycle = np.flatnonzero(in_tour)
+                costs = d[cycle][:, stale] + d[stale][:, successor[cycle]].T - d[cycle, successor[cycle]][:, None]
+                best_after[stale] = cycle[np.argmin(costs, axis=0)]
+                best_cost[stale] = costs.min(axis=0)
+            # The new edges (a, x) and (x, b)
+            for origin, target in ((a, x), (x, b)):
+                costs = (d[origin, :] + d[:, target] - d[origin, target]).astype(float)
+                costs[in_tour] = np.inf
+                better = costs < best_cost
+                best_after[better] = origin
+                best_cost[better] = costs[better]
+
+        tour = np.empty(n, dtype=int)
+        city = 0
+        for k in range(n):
+            tour[k] = city
+            city = successor[city]
+        return tour
+
+    @staticmethod
+    def farthest_insertion(distance_matrix, coordinates=None):
+        # Inserts the city farthest from the cycle at its cheapest position, which spans the outline early
+        d = distance_matrix
+        n = d.shape[0]
+        if n <= 3:
+            return np.arange(n)
+        tour = [0]
+        distance_to_tour = np.minimum(d[0, :], d[:, 0]).astype(float)
+        distance_to_tour[0] = -np.inf
+        for _ in range(n - 1):
+            x = int(np.argmax(distance_to_tour))
+            cycle = np.array(tour)
+            following = np.roll(cycle, -1)
+            position = int(np.argmin(d[cycle, x] + d[x, following] - d[cycle, following]))
+            tour.insert(position + 1, x)
+            distance_to_tour = np.minimum(distance_to_tour, np.minimum(d[x, :], d[:, x]))
+            distance_to_tour[x] = -np.inf
+            distance_to_tour[tour] = -np.inf
+        return np.array(tour)
+
+    @staticmethod
+    def space_filling_curve(distance_matrix, coordinates=None, order=16):
+        # Visits the cities in the order of a Hilbert curve through their coordinates, O(n log n)
+        if coordinates is None:
+            print("No coordinates available, using nearest neighbor instead of the space filling curve")
+            return TourConstructor.nearest_neighbor(distance_matrix)
+        points = np.asarray(coordinates, dtype=float)
+        span = np.ptp(points, axis=0)
+        span[span == 0] = 1
+        side = 1 << order
+        x, y = ((points - points.min(axis=0)) / span * (side - 1)).astype(np.int64).T
+        index = np.zeros(len(points), dtype=np.int64)
+        s = side >> 1
+        while s > 0:
+            rx = (x & s) > 0
+            ry = (y & s) > 0
+            index += s * s * ((3 * rx) ^ ry)
+            # Rotate the quadrant
+            flip = ~ry & rx
+            x = np.where(flip, s - 1 - x, x)
+            y = np.where(flip, s - 1 - y, y)
+            x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+            s >>= 1
+        return np.argsort(index, kind='stable')
+
+    @staticmethod
+    def assignment_patching(distance_matrix, coordinates=None):
+        # The subtours of the assignment problem patched into one tour, O(n^3) because of the Hungarian method
+        from scipy.optimize import linear_sum_assignment
+        d = distance_matrix.astype(float)
+        np.fill_diagonal(d, np.inf if d.shape[0] > 1 else 0)
+        rows, cols = linear_sum_assignment(d)
+        return np.array(patch_subtours(distance_matrix, find_subtours(cols)))
+
+    @staticmethod
+    def insert(distance_matrix, tour, cities):
+        # Inserts the cities one after another at the cheapest position of an existing open tour, O(len(cities) * n)
+        d = np.asarray(distance_matrix)
+        tour = list(tour)
+        for x in cities:
+            if len(tour) < 2:
+                tour.append(x)
+                continue
+            cycle = np.array(tour)
+            following = np.roll(cycle, -1)
+            position = int(np.argmin(d[cycle, x] + d[x, following] - d[cycle, following]))
+            tour.insert(position + 1, x)
+        return np.array(tour, dtype=int)
+
+class LowerBound:
+    # Lower bounds on the length of any tour, used to report how far a tour can be from the optimum
+
+    @classmethod
+    def compute(cls, distance_matrix, upper_bound=None, symmetric=None, time_limit_seconds=None):
+        # The assignment bound always holds, for symmetric matrices the Held-Karp 1-tree bound is usually much tighter.
+        # time_limit_seconds caps the subgradient iterations of the 1-tree bound, which dominate on large matrices
+        deadline = None if time_limit_seconds is None else time.monotonic() + time_limit_seconds
+        distance_matrix = np.asarray(distance_matrix)
+        bound = cls.assignment(distance_matrix)
+        if symmetric is None:
+            symmetric = np.array_equal(distance_matrix, distance_matrix.T)
+        if symmetric and (deadline is None or time.monotonic() < deadline):
+            bound = max(bound, cls.one_tree(distance_matrix, upper_bound, deadline=deadline))
+        return bound
+
+    @staticmethod
+    def assignment(distance_matrix):
+        # Every tour is an assignment of successors, so the cheapest assignment can't be longer
+        n = distance_matrix.shape[0]
+        if n < 2:
+            return 0
+        from scipy.optimize import linear_sum_assignment
+        d = distance_matrix.astype(float)
+        np.fill_diagonal(d, np.inf)
+        rows, cols = linear_sum_assignment(d)
+        return int(d[rows, cols].sum())
+
+    @staticmethod
+    def one_tree(distance_matrix, upper_bound=None, iterations=1000, patience=50, deadline=None):
+        # Held-Karp bound for symmetric matrices: minimum 1-trees under city penalties pi, improved with Polyak
+        # subgradient steps towards the upper bound. The step scale is halved after patience steps without improvement,
+        # a short patience stalls far below the optimum (e.g. on clustered stops). Stops at the monotonic deadline
+        d = distance_matrix.astype(float)
+        n = d.shape[0]
+        if n < 4:
+            return LowerBound.assignment(distance_matrix)
+        if upper_bound is None:
+            tour = TourConstructor.nearest_neighbor(distance_matrix)
+            upper_bound = d[tour, np.roll(tour, -1)].sum()
+
+        pi = np.zeros(n)
+        best = -np.inf
+        step_scale = 2.0
+        iterations_without_improvement = 0
+        for _ in range(iterations):
+            degree, length = LowerBound._minimum_one_tree(d + pi[:, None] + pi[None, :])
+            value = length - 2 * pi.sum()
+            if value > best + 1e-9:
+                best = value
+                iterations_without_improvement = 0
+            else:
+                iterations_without_improvement += 1
+                if iterations_without_improvement >= patience:
+                    step_scale /= 2
+                    iterations_without_improvement = 0
+            subgradient = degree - 2
+            # A 1-tree where every city has two edges is a tour, the bound can't get better
+            if not subgradient.any() or step_scale < 1e-4 or best >= upper_bound - 1e-6:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            pi += step_scale * (upper_bound - value) / (subgradient @ subgradient) * subgradient
+        # Tour lengths are integers
+        return int(np.ceil(best - 1e-6))
+
+    @staticmethod
+    def _minimum_one_tree(cost):
+        # Minimum spanning tree over cities 1..n-1 (Prim) plus the two cheapest edges of city 0
+        n = cost.shape[0]
+        sub = cost[1:, 1:]
+        in_tree = np.zeros(n - 1, dtype=bool)
+        in_tree[0] = True
+        key = sub[0].copy()
+        parent = np.zeros(n - 1, dtype=int)
+        degree = np.zeros(n, dtype=int)
+        length = 0.0
+        for _ in range(n - 2):
+            v = int(np.argmin(np.where(in_tree, np.inf, key)))
+            in_tree[v] = True
+            length += key[v]
+            degree[v + 1] += 1
+            degree[parent[v] + 1] += 1
+            closer = (sub[v] < key) & ~in_tree
+            key[closer] = sub[v][closer]
+            parent[closer] = v
+        nearest = np.argpartition(cost[0, 1:], 1)[:2]
+        length += cost[0, 1:][nearest].sum()
+        degree[0] = 2
+        degree[nearest + 1] += 1
+        return degree, length
+
+def as_distance_matrix(distance_matrix):
+    # The one form of the matrix that the solver and all methods share: C-contiguous int32 (half the size of
+    # the default int64) and read-only, so nothing copies it to be safe. Only copies if the input isn't in that form.
+    matrix = np.ascontiguousarray(distance_matrix, dtype=np.int32)
+    if matrix.flags.writeable:
+        matrix = matrix.view()
+        matrix.flags.writeable = False
+    return matrix
+
+class SharedMatrix:
+    # A distance matrix copied once into a shared memory block for the worker processes of a method. Workers
+    # attach() to it by name instead of receiving a copy each; the handle (name, size and whether the matrix is
+    # symmetric) is all that is pickled. The creating process frees the block with close() or as a context manager.
+    def __init__(self, distance_matrix, symmetric=None):
+        matrix = as_distance_matrix(distance_matrix)
+        if symmetric is None:
+            symmetric = bool(np.array_equal(matrix, matrix.T))
+        self.memory = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+        np.ndarray(matrix.shape, dtype=np.int32, buffer=self.memory.buf)[:] = matrix
+        self.handle = (self.memory.name, matrix.shape[0], symmetric)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def attach(handle):
+        # In a worker process: the shared memory block (keep it referenced), the read-only matrix and its symmetry
+        name, n, symmetric = handle
+        memory = shared_memory.SharedMemory(name=name)
+        matrix = np.ndarray((n, n), dtype=np.int32, buffer=memory.buf)
+        matrix.flags.writeable = False
+        return memory, matrix, symmetric
 
 class TSPMethod:
     def __init__(self, distance_matrix):
-        self.distance_matrix = np.array(distance_matrix)
+        # Read-only int32 and no copy (see as_distance_matrix), methods that need another type or want to modify the
+        # matrix convert it into their own array first
+        self.distance_matrix = as_distance_matrix(distance_matrix)
+        self.symmetric = None  # Computed on the first is_symmetric() unless known, e.g. from a SharedMatrix handle
+        self.coordinates = None  # Optional (lon, lat) per city, set by TSPSolverInterface
+        # Anytime solving: methods report every better tour through report() and poll should_stop()
+        self.progress_callback = None
+        self.report_interval_seconds = 0.5
+        # stop_event is the caller's cancel event and only polled; stop() sets the method's own flag instead, with the
+        # reason in stop_reason ('stopped', 'gap target' or 'callback'), so reaching the gap target isn't a cancel
+        self.stop_event = threading.Event()
+        self.stopped = threading.Event()
+        self.stop_reason = None
+        self.start_time = time.time()
+        self.best_reported_cost = None
+        self.last_report_time = 0.0
+        # Best known lower bound on the tour length; with gap_target set the method stops once
+        # (cost - bound) / cost of its incumbent falls to or below it
+        self.bound = None
+        self.gap_target = None
+        # Optional open tour to start from, e.g. the previous tour after stops were added or removed.
+        # Methods that can't use a start tour ignore it.
+        self.initial_tour = None
+        # Optional (n, k) array of the candidate neighbors of every city, used by the local search methods
+        # instead of the nearest cities by the matrix (e.g. the pairs with real durations of CandidateDurations)
+        self.candidate_lists = None
+        # Work done by the method (e.g. moves or search nodes) and the size of its model for the timing report,
+        # profiler times phases inside the method if TSPSolverInterface attached one
+        self.counters = {}
+        self.model_size = {}
+        self.profiler = None
 
     def solve(self, max_time_seconds):
         # This method should be overridden in subclasses and return True/False if optimal route was found and the tour itself 
         raise NotImplementedError("This method should be overridden in subclasses")
+
+    def set_progress_callback(self, callback, report_interval_seconds=0.5):
+        # callback(progress) receives a dict with 'cost', 'tour' (closed), 'elapsed', 'bound' and 'gap' (None if unknown).
+        # Returning True from the callback stops the method like stop() does.
+        self.progress_callback = callback
+        self.report_interval_seconds = report_interval_seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def is_symmetric(self):
+        if self.symmetric is None:
+            self.symmetric = bool(np.array_equal(self.distance_matrix, self.distance_matrix.T))
+        return self.symmetric
+
+    def shorter_direction(self, tour):
+        # The closed tour or the same tour driven backwards, whichever is shorter. With up to 3 cities these are the
+        # only two tours, so the result is optimal even for asymmetric travel times
+        tour = np.asarray(tour)
+        reverse = tour[::-1]
+        if self.distance_matrix[reverse[:-1], reverse[1:]].sum() < self.distance_matrix[tour[:-1], tour[1:]].sum():
+            return reverse
+        return tour
+
+    def stop(self, reason='stopped'):
+        # Can be called from another thread, the method then returns its best tour as soon as possible
+        if not self.stopped.is_set():
+            self.stop_reason = reason
+        self.stopped.set()
+
+    def should_stop(self):
+        return self.stopped.is_set() or self.stop_event.is_set()
+
+    def start_timer(self):
+        self.start_time = time.time()
+        self.best_reported_cost = None
+        self.last_report_time = 0.0
+        return self.start_time
+
+    def wants_report(self):
+        # Lets methods skip building a tour that report() would throw away; with a gap target every incumbent is checked
+        if self.gap_target is not None:
+            return True
+        return self.progress_callback is not None and time.time() - self.last_report_time >= self.report_interval_seconds
+
+    def gap(self, cost):
+        if self.bound is None:
+            return None
+        return max(cost - self.bound, 0) / cost if cost > 0 else 0.0
+
+    def report(self, tour, bound=None, force=False):
+        # Passes an improved tour to the progress callback, at most once per report_interval_seconds unless forced,
+        # and stops the method once the gap target is reached
+        if bound is not None:
+            self.bound = bound if self.bound is None else max(self.bound, bound)
+        if tour is None or (self.progress_callback is None and self.gap_target is None):
+            return
+        tour = np.asarray(tour)
+        if tour[0] != tour[-1]:
+            tour = np.append(tour, tour[0])
+        cost = int(self.distance_matrix[tour[:-1], tour[1:]].sum())
+        if self.gap_target is not None and self.bound is not None and self.gap(cost) <= self.gap_target and not self.should_stop():
+            print(f"Gap target reached: {self.gap(cost):.2%}")
+            self.stop('gap target')
+        if self.progress_callback is None:
+            return
+        if self.best_reported_cost is not None and cost >= self.best_reported_cost and not force:
+            return
+        now = time.time()
+        if not force and now - self.last_report_time < self.report_interval_seconds:
+            return
+        self.best_reported_cost = cost if self.best_reported_cost is None else min(cost, self.best_reported_cost)
+        self.last_report_time = now
+        progress = {'cost': cost, 'tour': tour.copy(), 'elapsed': now - self.start_time, 'bound': self.bound, 'gap': self.gap(cost)}
+        if self.progress_callback(progress):
+            self.stop('callback')
+
+    @contextmanager
+    def interrupt_on_stop(self, interrupt):
+        # For solvers that block in native code: a watcher thread calls interrupt() once stop() is requested
+        finished = threading.Event()
+
+        def watch():
+            while not finished.wait(0.1):
+                if self.should_stop():
+                    interrupt()
+                    return
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            yield
+        finally:
+            finished.set()
+            watcher.join()
     
-class TwoOptMethod(TSPMethod): 
-    def solve(self, max_time_seconds):
-        start_time = time.time()  # Record the start time
+class TwoOptMethod(TSPMethod):
+    def __init__(self, distance_matrix, num_neighbors=10, seed=None, constructor='farthest_insertion'):
+        super().__init__(distance_matrix)
+        self.num_neighbors = num_neighbors  # Size of the candidate list per city
+        self.seed = seed  # Start from a random tour drawn with this seed instead of the constructor
+        self.constructor = constructor  # One of TourConstructor.names
 
-        self.distance_matrix = self.distance_matrix.astype(int)  # Convert to integers
+    def solve(self, max_time_seconds):
+        start_time = self.start_timer()  # Record the start time
 
-        # Step 1: Initial solution using the Hungarian method
-        rows, cols = linear_sum_assignment(self.distance_matrix)
-        initial_tour = np.append(cols, cols[0])  # Create an initial tour
+        # Step 1: Initial solution
+        if self.initial_tour is not None:
+            initial_tour = np.asarray(self.initial_tour, dtype=int)
+        elif self.seed is None:
+            initial_tour = TourConstructor.construct(self.constructor, self.distance_matrix, self.coordinates)
+        else:
+            initial_tour = np.random.default_rng(self.seed).permutation(self.distance_matrix.shape[0])
+        initial_tour = np.append(initial_tour, initial_tour[0])  # Close the tour
+        self.report(initial_tour)
 
         # Step 2: Optimize the tour with 2-opt algorithm
         optimized_tour, optimal = self._two_opt(initial_tour, start_time, max_time_seconds)
+        self.report(optimized_tour, force=True)
 
         return optimal, optimized_tour
 
     def _two_opt(self, tour, start_time, max_time_seconds):
+        # Repeats 2-opt moves until none improves the tour. Moves are first searched among the nearest
+        # neighbors of each city (with don't-look bits), then a vectorized pass over all pairs confirms
+        # the local optimum. Segment costs come from prefix sums in both directions, so the deltas
+        # are exact for asymmetric matrices as well.
+        tour = np.array(tour[:-1])
         num_cities = len(tour)
-        optimal = True  # Initialize as True, will set to False if time limit is reached
-        for i in range(num_cities - 1):
-            for j in range(i + 2, num_cities - 1):
+        if num_cities < 4:
+            return self.shorter_direction(np.append(tour, tour[0])), True
+
+        neighbors = self._neighbor_lists(min(self.num_neighbors, num_cities - 1))
+        position = np.empty(num_cities, dtype=int)
+        position[tour] = np.arange(num_cities)
+        forward, backward = self._prefix_costs(tour)
+
+        # Cities whose don't-look bit is off
+        active = deque(tour.tolist())
+        queued = np.ones(num_cities, dtype=bool)
+
+        while True:
+            while active:
                 # Check if the time limit has been reached
-                elapsed_time = time.time() - start_time
-                if elapsed_time > max_time_seconds:
+                if time.time() - start_time > max_time_seconds or self.should_stop():
                     print("Time limit reached.")
-                    optimal = False  # Set optimal to False as time limit is reached
-                    return tour, optimal
-                # Don't swap first and last edge
-                if i == 0 and j == num_cities - 2:
-                    continue
+                    return np.append(tour, tour[0]), False
+
+                city = active.popleft()
+                queued[city] = False
+                self.count('candidate_checks')
+                move = self._candidate_move(tour, position, forward, backward, city, neighbors[city])
+                if move is not None:
+                    self.count('moves')
+                    for endpoint in self._apply_move(tour, position, *move):
+                        if not queued[endpoint]:
+                            queued[endpoint] = True
+                            active.append(endpoint)
+                    forward, backward = self._prefix_costs(tour)
+                    self.report(tour)
+
+            # The candidate lists are exhausted, look for an improving move among all pairs
+            self.count('full_passes')
+            improved = False
+            for i in range(num_cities - 2):
+                if time.time() - start_time > max_time_seconds or self.should_stop():
+                    print("Time limit reached.")
+                    return np.append(tour, tour[0]), False
+                j = np.arange(i + 2, num_cities)
+                deltas = self._move_deltas(tour, forward, backward, np.full(len(j), i), j)
+                best = np.argmin(deltas)
+                if deltas[best] < 0:
+                    self.count('moves')
+                    for endpoint in self._apply_move(tour, position, i, j[best]):
+                        queued[endpoint] = True
+                        active.append(endpoint)
+                    forward, backward = self._prefix_costs(tour)
+                    improved = True
+                    break
+            if not improved:
+                # A 2-opt local optimum, which says nothing about optimality
+                return np.append(tour, tour[0]), False
 
-                old_distance = self.distance_matrix[tour[i], tour[i + 1]] + self.distance_matrix[tour[j], tour[j + 1]]
-                new_distance = self.distance_matrix[tour[i], tour[j]] + self.distance_matrix[tour[i + 1], tour[j + 1]]
-                
-                # If the swap gives a shorter tour, do it
-                if new_distance < old_distance:
-                    tour[i + 1 : j + 1] = tour[j : i : -1]
+    def _candidate_move(self, tour, position, forward, backward, city, candidates):
+        # Best improving move adding the edge city -> candidate or predecessor of city -> predecessor of candidate,
+        # returned as (i, j) for _apply_move, or None
+        num_cities = len(tour)
+        p = position[city]
+        q = position[candidates]
+        i = np.concatenate([np.full(len(q), p), np.full(len(q), (p - 1) % num_cities)])
+        j = np.concatenate([q, (q - 1) % num_cities])
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        valid = j - i >= 2
+        if not valid.any():
+            return None
+        i, j = i[valid], j[valid]
+        deltas = self._move_deltas(tour, forward, backward, i, j)
+        best = np.argmin(deltas)
+        if deltas[best] < 0:
+            return i[best], j[best]
+        return None
+
+    def _neighbor_lists(self, k):
+        # The k closest cities of every city, in either direction
+        if self.candidate_lists is not None:
+            return np.asarray(self.candidate_lists)
+        cost = np.minimum(self.distance_matrix, self.distance_matrix.T).astype(float)
+        np.fill_diagonal(cost, np.inf)
+        return np.argpartition(cost, k - 1, axis=1)[:, :k]
+
+    def _prefix_costs(self, tour):
+        # forward[k] / backward[k]: cost of the first k edges of the closed tour traversed forwards / backwards
+        closed = np.append(tour, tour[0])
+        forward = np.concatenate([[0], np.cumsum(self.distance_matrix[closed[:-1], closed[1:]])])
+        backward = np.concatenate([[0], np.cumsum(self.distance_matrix[closed[1:], closed[:-1]])])
+        return forward, backward
+
+    def _move_deltas(self, tour, forward, backward, i, j):
+        # Change in tour length when reversing tour[i+1..j] (i < j), i.e. replacing the edges
+        # (t_i, t_i+1), (t_j, t_j+1) with (t_i, t_j), (t_i+1, t_j+1)
+        d = self.distance_matrix
+        ti, ti1, tj, tj1 = tour[i], tour[i + 1], tour[j], tour[(j + 1) % len(tour)]
+        reversal = (backward[j] - backward[i + 1]) - (forward[j] - forward[i + 1])
+        return d[ti, tj] + d[ti1, tj1] - d[ti, ti1] - d[tj, tj1] + reversal
+
+    def _apply_move(self, tour, position, i, j):
+        # Reverses tour[i+1..j] in place and returns the cities at the four touched edge ends
+        endpoints = (tour[i], tour[i + 1], tour[j], tour[(j + 1) % len(tour)])
+        tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1].copy()
+        position[tour[i + 1:j + 1]] = np.arange(i + 1, j + 1)
+        return endpoints
+
+class IteratedLocalSearchMethod(TwoOptMethod):
+    def __init__(self, distance_matrix, num_neighbors=10, seed=None, constructor='farthest_insertion', max_segment_length=3,
+                 max_iterations_without_improvement=5000, kick_window=50):
+        super().__init__(distance_matrix, num_neighbors, seed, constructor)
+        self.max_segment_length = max_segment_length  # Longest segment moved by Or-opt
+        self.max_iterations_without_improvement = max_iterations_without_improvement
+        self.kick_window = kick_window  # The double bridge cuts the tour within this many positions
+
+    def solve(self, max_time_seconds):
+        # Iterated local search: 2-opt and Or-opt moves until no candidate move improves the tour, then a
+        # local double bridge kick and another local search around the touched cities, keeping the best tour.
+        # Or-opt moves segments without reversing them, so they are exact for asymmetric travel times.
+        start_time = self.start_timer()  # Record the start time
+        deadline = start_time + max_time_seconds
+
+        n = self.distance_matrix.shape[0]
+        if n <= 3:
+            return True, self.shorter_direction(np.append(np.arange(n), 0))
+        rng = np.random.default_rng(self.seed)
+        self.neighbors = self._neighbor_lists(min(self.num_neighbors, n - 1))
+
+        # Initial solution
+        if self.initial_tour is not None:
+            tour = np.asarray(self.initial_tour, dtype=int)
+        else:
+            tour = TourConstructor.construct(self.constructor, self.distance_matrix, self.coordinates)
+        tour, finished = self._local_search(tour, tour.tolist(), deadline)
+        best_tour, best_cost = tour.copy(), self._tour_cost(tour)
+        self.report(best_tour)
+
+        iterations_without_improvement = 0
+        while finished and n >= 8 and iterations_without_improvement < self.max_iterations_without_improvement:
+            if time.time() > deadline or self.should_stop():
+                break
+            candidate = best_tour.copy()
+            self.count('kicks')
+            touched = self._double_bridge(candidate, rng)
+            candidate, finished = self._local_search(candidate, touched, deadline)
+            cost = self._tour_cost(candidate)
+            if cost < best_cost:
+                best_tour, best_cost = candidate, cost
+                iterations_without_improvement = 0
+                self.count('improvements')
+                self.report(best_tour)
+            else:
+                iterations_without_improvement += 1
+
+        if time.time() > deadline:
+            print("Time limit reached.")
+        best_tour = np.append(best_tour, best_tour[0])
+        self.report(best_tour, force=True)
+        return False, best_tour
+
+    def _tour_cost(self, tour):
+        return int(self.distance_matrix[tour, np.roll(tour, -1)].sum())
+
+    def _local_search(self, tour, active_cities, deadline):
+        # Applies improving 2-opt and Or-opt moves around the active cities (don't-look bits) until none is left
+        n = len(tour)
+        position = np.empty(n, dtype=int)
+        position[tour] = np.arange(n)
+        forward, backward = self._prefix_costs(tour)
+        active = deque(active_cities)
+        queued = np.zeros(n, dtype=bool)
+        queued[list(active_cities)] = True
+
+        while active:
+            if time.time() > deadline or self.should_stop():
+                return tour, False
+            city = active.popleft()
+            queued[city] = False
+            self.count('candidate_checks')
+
+            move = self._candidate_move(tour, position, forward, backward, city, self.neighbors[city])
+            if move is not None:
+                touched = self._apply_move(tour, position, *move)
+            else:
+                touched = self._or_opt_move(tour, position, city)
+                if touched is None:
+                    continue
+                position[tour] = np.arange(n)
+            self.count('moves')
+            forward, backward = self._prefix_costs(tour)
+            for endpoint in touched:
+                if not queued[endpoint]:
+                    queued[endpoint] = True
+                    active.append(endpoint)
+        return tour, True
+
+    def _or_opt_move(self, tour, position, city):
+        # Moves the segment starting at city (1 to max_segment_length cities) between two cities a -> b close
+        # to its ends, keeping its direction. Returns the cities at the changed edges or None if nothing improves.
+        d = self.distance_matrix
+        n = len(tour)
+        p = position[city]
+        best = None
+        for length in range(1, min(self.max_segment_length, n - 3) + 1):
+            first, last = tour[p], tour[(p + length - 1) % n]
+            previous, following = tour[(p - 1) % n], tour[(p + length) % n]
+            removal_gain = d[previous, first] + d[last, following] - d[previous, following]
+
+            # Insert after a neighbor of the first city or before a neighbor of the last city
+            a = np.concatenate([self.neighbors[first], tour[(position[self.neighbors[last]] - 1) % n]])
+            b = tour[(position[a] + 1) % n]
+            outside = ((position[a] - p) % n >= length) & ((position[b] - p) % n >= length) & (a != previous)
+            if not outside.any():
+                continue
+            a, b = a[outside], b[outside]
+            deltas = d[a, first] + d[last, b] - d[a, b] - removal_gain
+            k = np.argmin(deltas)
+            if deltas[k] < 0 and (best is None or deltas[k] < best[0]):
+                best = (deltas[k], length, a[k], b[k], previous, following)
+
+        if best is None:
+            return None
+        _, length, a, b, previous, following = best
+        rotated = np.roll(tour, -p)
+        segment, rest = rotated[:length], rotated[length:]
+        k = int(np.flatnonzero(rest == a)[0])
+        tour[:] = np.concatenate([rest[:k + 1], segment, rest[k + 1:]])
+        return previous, following, a, b, segment[0], segment[-1]
+
+    def _double_bridge(self, tour, rng):
+        # Splits the tour as A B C D (with B and C close together) and reconnects it as A C B D, in place
+        n = len(tour)
+        tour[:] = np.roll(tour, -rng.integers(n))
+        window = min(self.kick_window, n - 1)
+        a, b, c = np.sort(rng.choice(np.arange(1, window + 1), size=3, replace=False))
+        touched = [tour[a - 1], tour[a], tour[b - 1], tour[b], tour[c - 1], tour[c % n]]
+        tour[:] = np.concatenate([tour[:a], tour[b:c], tour[a:b], tour[c:]])
+        return touched
 
-        return tour, optimal
-    
 class PermutationsMethod(TSPMethod):
     def solve(self, max_time_seconds):
-        start_time = time.time()  # Record the start time
+        start_time = self.start_timer()  # Record the start time
 
         n = self.distance_matrix.shape[0]
         best_tour = None
@@ -214,63 +1682,171 @@ class PermutationsMethod(TSPMethod):
             # Check if the time limit has been reached
             
             elapsed_time = time.time() - start_time
-            if elapsed_time > max_time_seconds:
+            if elapsed_time > max_time_seconds or self.should_stop():
                 print("Time limit reached.")
                 optimal = False  # Set optimal to False as time limit is reached
-                return optimal, best_tour  # Return the best tour found so far and optimal status
+                self.report(best_tour, force=True)
+                return optimal, np.append(best_tour, best_tour[0]) if best_tour is not None else None  # Return the best tour found so far and optimal status
 
+            self.count('permutations')
             distance = sum(self.distance_matrix[tour[i-1], tour[i]] for i in range(n))
             if distance < best_distance:
                 best_distance = distance
                 best_tour = tour
+                self.report(best_tour)
 
         # Add the first city to the end of the tour
         best_tour = np.append(best_tour, best_tour[0])
+        self.report(best_tour, force=True)
 
         return optimal, np.array(best_tour)  # Return the best tour and whether it's optimal
 
-class FlowBasedMethod(TSPMethod):
-    def solve(self, max_time_seconds):
-        self.distance_matrix = self.distance_matrix.astype(int)  # integers required by SCIP
-        np.fill_diagonal(self.distance_matrix, np.iinfo(np.int32).max)  # Discourage staying in the same city
-        n = self.distance_matrix.shape[0]
-        
-        # Create the linear solver
-        solver = pywraplp.Solver.CreateSolver('SCIP')
-        
-        # Set the time limit in milliseconds
-        solver.set_time_limit(int(max_time_seconds * 1000))
-
-        # Create variables
-        x = {}
-        for i in range(n):
-            for j in range(n):
-                x[i, j] = solver.IntVar(0, 1, f'x_{i}_{j}')
-
-        u = [solver.IntVar(0, n, f'u_{i}') for i in range(n)]
+class HeldKarpMethod(TSPMethod):
+    def __init__(self, distance_matrix, max_cities=20):
+        super().__init__(distance_matrix)
+        self.max_cities = max_cities  # 2^19 * 19 table entries at 20 cities, about 90 MB
 
-        # Constraints
-        for i in range(n):
-            solver.Add(solver.Sum(x[i, j] for j in range(n)) == 1)  # each city must be departed from exactly once
-            solver.Add(solver.Sum(x[j, i] for j in range(n)) == 1)  # each city must be visited exactly once
+    def solve(self, max_time_seconds):
+        # Exact dynamic programming over subsets: dp[mask, j] is the shortest path that starts in city 0,
+        # visits the cities in mask and ends in j. Each subset size is computed as one NumPy batch per end city.
+        start_time = self.start_timer()  # Record the start time
 
-        for i in range(1, n):
-            for j in range(1, n):
-                if i != j:
-                    solver.Add(u[i] - u[j] + n * x[i, j] <= n - 1)  # subtour elimination
+        self.distance_matrix = self.distance_matrix.astype(np.int64)
+        n = self.distance_matrix.shape[0]
+        if n > self.max_cities:
+            print(f"HeldKarp is limited to {self.max_cities} cities, got {n}")
+            return False, None
+        if n <= 3:
+            return True, self.shorter_direction(np.append(np.arange(n), 0))
+
+        # City 0 is the fixed start, bit j of mask stands for city j + 1
+        m = n - 1
+        d = self.distance_matrix[1:, 1:]
+        self.model_size['states'] = (1 << m) * m
+        unreached = np.iinfo(np.int64).max // 4
+        dp = np.full((1 << m, m), unreached, dtype=np.int64)
+        parent = np.full((1 << m, m), -1, dtype=np.int8)
+        dp[1 << np.arange(m), np.arange(m)] = self.distance_matrix[0, 1:]
+
+        masks = np.arange(1 << m)
+        sizes = np.zeros(1 << m, dtype=np.int8)
+        for bit in range(m):
+            sizes += (masks >> bit) & 1
+
+        for size in range(2, m + 1):
+            # Check if the time limit has been reached
+            if time.time() - start_time > max_time_seconds or self.should_stop():
+                print("Time limit reached.")
+                return False, None
+            layer = masks[sizes == size]
+            for j in range(m):
+                selected = layer[(layer >> j) & 1 == 1]
+                # Paths over the subset without j, extended by the edge k -> j
+                candidates = dp[selected ^ (1 << j)] + d[:, j]
+                best = np.argmin(candidates, axis=1)
+                dp[selected, j] = candidates[np.arange(len(selected)), best]
+                parent[selected, j] = best
+                self.count('transitions', candidates.size)
+
+        # Close the tour back to city 0 and walk the parents backwards
+        full = (1 << m) - 1
+        closed = dp[full] + self.distance_matrix[1:, 0]
+        last = int(np.argmin(closed))
+        optimum = int(closed[last])  # The length of the optimal tour, i.e. also its lower bound
+        tour = []
+        mask = full
+        while last != -1:
+            tour.append(last + 1)
+            mask, last = mask ^ (1 << last), int(parent[mask, last])
+
+        tour = np.array([0] + tour[::-1] + [0])
+        cost = int(self.distance_matrix[tour[:-1], tour[1:]].sum())
+        if cost != optimum:
+            raise RuntimeError(f"HeldKarp reconstructed a tour of length {cost} instead of the optimum {optimum}")
+        self.report(tour, bound=optimum, force=True)
+        return True, tour
 
-        # Objective function: minimize the total distance
-        solver.Minimize(solver.Sum(self.distance_matrix[i, j] * x[i, j] for i in range(n) for j in range(n)))
+class FlowBasedMethod(TSPMethod):
+    def __init__(self, distance_matrix, formulation='MTZ', use_symmetry=True):
+        super().__init__(distance_matrix)
+        # 'MTZ' builds all subtour elimination constraints up front,
+        # 'DFJ' starts from the assignment problem and only adds the subtour constraints that are violated
+        if formulation not in ('MTZ', 'DFJ'):
+            raise ValueError(f"Unknown formulation: {formulation}")
+        self.formulation = formulation
+        self.use_symmetry = use_symmetry  # DFJ only: one variable per edge if the matrix is symmetric
 
-        # Solve the problem
-        status = solver.Solve()
+    def solve(self, max_time_seconds):
+        self.start_timer()
+        if self.formulation == 'DFJ':
+            return self._solve_dfj(max_time_seconds)
+        from ortools.linear_solver import pywraplp
+
+        # Own copy for the objective, the shared matrix is read-only
+        cost = self.distance_matrix.astype(np.int64)
+        np.fill_diagonal(cost, np.iinfo(np.int32).max)  # Discourage staying in the same city
+        n = self.distance_matrix.shape[0]
+        
+        with profile_span(self.profiler, 'model building'):
+            # Create the linear solver
+            solver = pywraplp.Solver.CreateSolver('SCIP')
+
+            # Set the time limit in milliseconds
+            solver.set_time_limit(int(max_time_seconds * 1000))
+
+            # Create variables
+            x = {}
+            for i in range(n):
+                for j in range(n):
+                    x[i, j] = solver.IntVar(0, 1, f'x_{i}_{j}')
+
+            u = [solver.IntVar(0, n, f'u_{i}') for i in range(n)]
+
+            # Constraints
+            for i in range(n):
+                solver.Add(solver.Sum(x[i, j] for j in range(n)) == 1)  # each city must be departed from exactly once
+                solver.Add(solver.Sum(x[j, i] for j in range(n)) == 1)  # each city must be visited exactly once
+
+            for i in range(1, n):
+                for j in range(1, n):
+                    if i != j:
+                        solver.Add(u[i] - u[j] + n * x[i, j] <= n - 1)  # subtour elimination
+
+            # Objective function: minimize the total distance
+            solver.Minimize(solver.Sum(int(cost[i, j]) * x[i, j] for i in range(n) for j in range(n)))
+        self.model_size.update(variables=solver.NumVariables(), constraints=solver.NumConstraints())
+
+        # Solve the problem, stop() interrupts SCIP. With a gap target SCIP itself stops once its incumbent is proven
+        # to be within it, it doesn't report incumbents while it runs
+        parameters = pywraplp.MPSolverParameters()
+        if self.gap_target is not None:
+            parameters.SetDoubleParam(pywraplp.MPSolverParameters.RELATIVE_MIP_GAP, self.gap_target)
+            if self.bound is not None:
+                # SCIP measures the gap against its own bound, which starts out far weaker than the known one
+                solver.Add(solver.Sum(int(cost[i, j]) * x[i, j] for i in range(n) for j in range(n) if i != j) >= int(self.bound))
+            # A constructed tour as the first incumbent, which may already be within the gap target
+            if self.initial_tour is not None:
+                start = np.asarray(self.initial_tour, dtype=int)
+            else:
+                start = TourConstructor.construct('farthest_insertion', self.distance_matrix, self.coordinates)
+            start = np.roll(start, -int(np.argmax(start == 0)))
+            successor = np.empty(n, dtype=int)
+            successor[start] = np.roll(start, -1)
+            position = np.argsort(start)
+            solver.SetHint([x[i, j] for i in range(n) for j in range(n)] + u,
+                           [float(successor[i] == j) for i in range(n) for j in range(n)] + [float(position[i]) for i in range(n)])
+        with self.interrupt_on_stop(solver.InterruptSolve), profile_span(self.profiler, 'MIP search'):
+            status = solver.Solve(parameters)
+        self.count('branch_and_bound_nodes', solver.nodes())
+        self.count('simplex_iterations', solver.iterations())
 
         # Initialize tour list with the first city
         tour = [0]
 
-        # Extract the tour if a solution exists
+        # Extract the tour if a solution exists. SCIP also reports OPTIMAL when it stopped at the gap target,
+        # then only the bound can prove optimality (tour lengths are integers)
         if status == pywraplp.Solver.OPTIMAL:
-            optimal = True
+            optimal = self.gap_target is None or np.ceil(solver.Objective().BestBound() - 1e-6) >= solver.Objective().Value() - 1e-6
         else:
             optimal = False  # Assume time limit reached if not OPTIMAL
             if status != pywraplp.Solver.FEASIBLE:
@@ -292,41 +1868,186 @@ class FlowBasedMethod(TSPMethod):
         if not optimal:
             print("Time limit reached.")
 
+        self.report(tour, bound=solver.Objective().BestBound(), force=True)
         return optimal, np.array(tour)
 
+    def _solve_dfj(self, max_time_seconds):
+        start_time = self.start_time
+
+        n = self.distance_matrix.shape[0]
+        if n <= 3:
+            return True, self.shorter_direction(np.append(np.arange(n), 0))
+        symmetric = self.use_symmetry and self.is_symmetric()
+        from ortools.linear_solver import pywraplp
+
+        with profile_span(self.profiler, 'model building'):
+            # Create the linear solver
+            solver = pywraplp.Solver.CreateSolver('SCIP')
+
+            # Create variables, the diagonal is left out entirely
+            if symmetric:
+                x = {(i, j): solver.BoolVar(f'x_{i}_{j}') for i in range(n) for j in range(i + 1, n)}
+                for i in range(n):
+                    # every city has exactly two incident edges
+                    solver.Add(solver.Sum(x[min(i, j), max(i, j)] for j in range(n) if j != i) == 2)
+            else:
+                x = {(i, j): solver.BoolVar(f'x_{i}_{j}') for i in range(n) for j in range(n) if i != j}
+                for i in range(n):
+                    solver.Add(solver.Sum(x[i, j] for j in range(n) if j != i) == 1)  # each city must be departed from exactly once
+                    solver.Add(solver.Sum(x[j, i] for j in range(n) if j != i) == 1)  # each city must be visited exactly once
+                for i, j in x:
+                    if i < j:
+                        solver.Add(x[i, j] + x[j, i] <= 1)  # no subtours of two cities
+
+            # Objective function: minimize the total distance
+            solver.Minimize(solver.Sum(int(self.distance_matrix[i, j]) * var for (i, j), var in x.items()))
+
+        best_tour = None
+        best_cost = None
+        while True:
+            remaining = max_time_seconds - (time.time() - start_time)
+            if remaining <= 0 or self.should_stop():
+                break
+            solver.set_time_limit(int(remaining * 1000))
+            with self.interrupt_on_stop(solver.InterruptSolve), profile_span(self.profiler, 'MIP search'):
+                status = solver.Solve()
+            self.count('mip_solves')
+            self.count('branch_and_bound_nodes', solver.nodes())
+            self.model_size.update(variables=solver.NumVariables(), constraints=solver.NumConstraints())
+            if status not in (pywraplp.Solver.OPTIMAL, pywraplp.Solver.FEASIBLE):
+                break
+            # Every solve is a relaxation of the TSP, so its bound is a lower bound for the tour length
+            bound = solver.Objective().BestBound()
+
+            subtours = find_subtours(self._dfj_successors(x, n, symmetric))
+            if len(subtours) == 1:
+                tour = subtours[0]
+                start = tour.index(0)
+                tour = tour[start:] + tour[:start] + [0]
+                if status != pywraplp.Solver.OPTIMAL:
+                    print("Time limit reached.")
+                self.report(tour, bound=bound, force=True)
+                return status == pywraplp.Solver.OPTIMAL, np.array(tour)
+
+            # Forbid every subtour of the current solution and solve again
+            for subtour in subtours:
+                solver.Add(solver.Sum(x[i, j] for i in subtour for j in subtour if (i, j) in x) <= len(subtour) - 1)
+            self.count('subtour_cuts', len(subtours))
+
+            # Keep a patched tour in case the time runs out before the subtours are gone
+            tour = patch_subtours(self.distance_matrix, subtours)
+            cost = int(self.distance_matrix[tour, np.roll(tour, -1)].sum())
+            if best_cost is None or cost < best_cost:
+                start = tour.index(0)
+                best_tour, best_cost = tour[start:] + tour[:start] + [0], cost
+            self.report(best_tour, bound=bound)
+
+        print("Time limit reached.")
+        if best_tour is None:
+            print("No solution found")
+            return False, None
+        return False, np.array(best_tour)
+
+    def _dfj_successors(self, x, n, symmetric):
+        successor = np.zeros(n, dtype=int)
+        if not symmetric:
+            for (i, j), var in x.items():
+                if var.solution_value() > 0.5:
+                    successor[i] = j
+            return successor
+
+        # Orient the undirected cycles
+        adjacent = [[] for _ in range(n)]
+        for (i, j), var in x.items():
+            if var.solution_value() > 0.5:
+                adjacent[i].append(j)
+                adjacent[j].append(i)
+        visited = np.zeros(n, dtype=bool)
+        for start in range(n):
+            if visited[start]:
+                continue
+            previous, city = -1, start
+            while True:
+                visited[city] = True
+                following = adjacent[city][0] if adjacent[city][0] != previous else adjacent[city][1]
+                successor[city] = following
+                previous, city = city, following
+                if city == start:
+                    break
+        return successor
+
 class ConstraintProgrammingMethod(TSPMethod):
+    def __init__(self, distance_matrix, first_solution_strategy='PATH_CHEAPEST_ARC', metaheuristic='AUTOMATIC',
+                 solution_limit=None, log_search=False):
+        super().__init__(distance_matrix)
+        # Names of routing_enums_pb2.FirstSolutionStrategy / LocalSearchMetaheuristic values,
+        # e.g. 'SAVINGS' or 'CHRISTOFIDES' and 'GUIDED_LOCAL_SEARCH', 'SIMULATED_ANNEALING' or 'TABU_SEARCH'.
+        # Note that the metaheuristics only stop at the time or solution limit.
+        from ortools.constraint_solver import routing_enums_pb2
+        self.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy)
+        self.metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+        self.solution_limit = solution_limit
+        self.log_search = log_search
+
     def solve(self, max_time_seconds):
-        self.distance_matrix = self.distance_matrix.astype(int)
+        self.start_timer()
+        from ortools.constraint_solver import routing_enums_pb2, pywrapcp
         n = self.distance_matrix.shape[0]
 
         # Create the routing model
         manager = pywrapcp.RoutingIndexManager(n, 1, 0)
         routing = pywrapcp.RoutingModel(manager)
 
-        # Create the distance callback
-        def distance_callback(i, j):
-            return self.distance_matrix[manager.IndexToNode(i), manager.IndexToNode(j)]
+        # Hand the matrix to OR-tools directly so arc costs are looked up natively instead of in a Python callback
+        if hasattr(routing, 'RegisterTransitMatrix'):
+            transit_callback_index = routing.RegisterTransitMatrix(self.distance_matrix.tolist())
+        else:
+            # Older OR-tools versions only know callbacks
+            def distance_callback(i, j):
+                return int(self.distance_matrix[manager.IndexToNode(i), manager.IndexToNode(j)])
 
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+            transit_callback_index = routing.RegisterTransitCallback(distance_callback)
 
         # Define cost of each arc
         routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
         # Set parameters
         search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.time_limit.seconds = max_time_seconds
-        search_parameters.first_solution_strategy = (
-            routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+        search_parameters.time_limit.FromMilliseconds(int(max_time_seconds * 1000))
+        search_parameters.first_solution_strategy = self.first_solution_strategy
+        search_parameters.local_search_metaheuristic = self.metaheuristic
+        if self.solution_limit is not None:
+            search_parameters.solution_limit = self.solution_limit
+        search_parameters.log_search = self.log_search
+
+        # Report every improved solution and end the search once stop() was called
+        def on_solution():
+            self.count('solutions')
+            if self.wants_report():
+                tour = []
+                index = routing.Start(0)
+                while not routing.IsEnd(index):
+                    tour.append(manager.IndexToNode(index))
+                    index = routing.NextVar(index).Value()
+                self.report(tour)
+            if self.should_stop():
+                routing.solver().FinishCurrentSearch()
+
+        routing.AddAtSolutionCallback(on_solution)
 
         # Solve the problem
         solution = routing.SolveWithParameters(search_parameters)
+        self.count('branches', routing.solver().Branches())
+        self.model_size.update(nodes=n, arcs=n * (n - 1))
+
+        # Only a proven optimum counts as optimal, a finished local search doesn't
+        status = routing.status()
+        optimal = status == routing_enums_pb2.RoutingSearchStatus.ROUTING_OPTIMAL
+        print("Routing status:", routing_enums_pb2.RoutingSearchStatus.Value.Name(status))
 
         # Initialize tour list
         tour = []
 
-        # Determine if the solution is optimal
-        optimal = (solution is not None)
-
         # Extract the tour if a solution exists
         if solution:
             index = routing.Start(0)
@@ -335,38 +2056,394 @@ class ConstraintProgrammingMethod(TSPMethod):
                 index = solution.Value(routing.NextVar(index))
             # Add the first city to the end of the tour
             tour.append(0)
+            self.report(tour, force=True)
+        else:
+            print("No solution found")
+
+        return optimal, np.array(tour) if tour else None
+
+_portfolio_matrix = None
+_portfolio_symmetric = None
+_portfolio_stop_event = None
+_portfolio_progress_queue = None
+_portfolio_shared_memory = None
+
+def _init_portfolio_worker(matrix_handle, stop_event, progress_queue):
+    # Attaches the worker process to the SharedMatrix, the matrix itself is never copied or pickled
+    global _portfolio_matrix, _portfolio_symmetric, _portfolio_stop_event, _portfolio_progress_queue, _portfolio_shared_memory
+    _portfolio_shared_memory, _portfolio_matrix, _portfolio_symmetric = SharedMatrix.attach(matrix_handle)
+    _portfolio_stop_event = stop_event
+    _portfolio_progress_queue = progress_queue
+
+def _run_portfolio_member(index, method_name, params, deadline):
+    max_time_seconds = deadline - time.time()
+    if max_time_seconds <= 0 or _portfolio_stop_event.is_set():
+        return index, False, None
+    method = TSPMethodFactory.create_method(method_name, _portfolio_matrix, **params)
+    method.symmetric = _portfolio_symmetric
+    method.stop_event = _portfolio_stop_event
+    method.set_progress_callback(lambda progress: _portfolio_progress_queue.put((index, progress['tour'].tolist(), progress['bound'])))
+    optimal, tour = method.solve(max_time_seconds)
+    return index, optimal, None if tour is None else [int(city) for city in tour]
+
+class PortfolioMethod(TSPMethod):
+    def __init__(self, distance_matrix, members=None, num_random_starts=4, max_workers=None):
+        super().__init__(distance_matrix)
+        # members: list of (method name, parameters) raced against each other, by default a mix of exact
+        # methods (if the instance is small enough), OR-tools metaheuristics and randomly started 2-opt runs.
+        # All members share the time limit, so only the first max_workers of them run (one per worker)
+        self.members = members
+        self.num_random_starts = num_random_starts
+        self.max_workers = max_workers or os.cpu_count()
+
+    def default_members(self, n):
+        # Most promising first, fewer workers than members drop the ones at the end
+        members = []
+        if n <= 20:
+            members.append(("HeldKarp", {}))
+        members.append(("IteratedLocalSearch", {'seed': 0}))
+        if n <= 200:
+            members.append(("FlowBasedDFJ", {}))
+        members.append(("ConstraintProgramming", {'metaheuristic': 'GUIDED_LOCAL_SEARCH'}))
+        members.append(("ConstraintProgramming", {'first_solution_strategy': 'SAVINGS', 'metaheuristic': 'SIMULATED_ANNEALING'}))
+        members.append(("TwoOpt", {'constructor': 'greedy_edge'}))
+        members.append(("TwoOpt", {}))
+        members.extend(("TwoOpt", {'seed': seed}) for seed in range(self.num_random_starts))
+        return members
 
+    def solve(self, max_time_seconds):
+        start_time = self.start_timer()  # Record the start time
+        deadline = start_time + max_time_seconds
+
+        n = self.distance_matrix.shape[0]
+        members = self.members if self.members is not None else self.default_members(n)
+        if len(members) > self.max_workers:
+            # A member queued behind another one would only start once the time limit is over
+            if self.members is not None:
+                print(f"Portfolio runs the first {self.max_workers} of {len(members)} members, one per worker")
+            members = members[:self.max_workers]
+        self.model_size['members'] = len(members)
+
+        # One read-only copy of the matrix in shared memory for all workers
+        matrix = self.distance_matrix
+        shared = SharedMatrix(matrix, self.symmetric)
+
+        context = multiprocessing.get_context('spawn')
+        stop_event = context.Event()
+        progress_queue = context.Queue()
+        executor = ProcessPoolExecutor(
+            max_workers=len(members), mp_context=context,
+            initializer=_init_portfolio_worker,
+            initargs=(shared.handle, stop_event, progress_queue)
+        )
+
+        best_tour = None
+        best_cost = None
+        optimal = False
+
+        def consider(tour, bound=None):
+            nonlocal best_tour, best_cost
+            self.count('member_tours')
+            cost = int(matrix[tour[:-1], tour[1:]].sum())
+            if best_cost is None or cost < best_cost:
+                best_tour, best_cost = tour, cost
+            self.report(best_tour, bound=bound)
+            if self.should_stop():
+                stop_event.set()
+
+        try:
+            pending = {executor.submit(_run_portfolio_member, index, name, params, deadline) for index, (name, params) in enumerate(members)}
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                # Incumbents streamed by the members
+                while not progress_queue.empty():
+                    index, tour, bound = progress_queue.get()
+                    consider(np.array(tour), bound)
+                for future in done:
+                    index, member_optimal, tour = future.result()
+                    if tour is None:
+                        continue
+                    consider(np.array(tour))
+                    if member_optimal:
+                        # One member proved optimality, the others can stop
+                        print(f"Optimal tour proven by {members[index][0]}")
+                        best_tour, best_cost = np.array(tour), int(matrix[tour[:-1], tour[1:]].sum())
+                        self.bound = best_cost
+                        optimal = True
+                        stop_event.set()
+                if self.should_stop() or time.time() > deadline:
+                    stop_event.set()
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            shared.close()
+
+        if best_tour is None:
+            print("No solution found")
+            return False, None
         if not optimal:
             print("Time limit reached.")
+        self.report(best_tour, force=True)
+        return optimal, best_tour
+
+def _run_cluster_member(cities, method_name, params, deadline):
+    # Solves the part of the shared matrix (see _init_portfolio_worker) between the given cities,
+    # returns the open tour in the indices of the full matrix or None
+    max_time_seconds = deadline - time.time()
+    if max_time_seconds <= 0 or _portfolio_stop_event.is_set():
+        return None
+    cities = np.asarray(cities)
+    method = TSPMethodFactory.create_method(method_name, _portfolio_matrix[np.ix_(cities, cities)], **params)
+    method.symmetric = _portfolio_symmetric or None  # A part of a symmetric matrix is symmetric too
+    method.stop_event = _portfolio_stop_event
+    optimal, tour = method.solve(max_time_seconds)
+    return None if tour is None else cities[np.asarray(tour[:-1])].tolist()
+
+class ClusterDecompositionMethod(TSPMethod):
+    def __init__(self, distance_matrix, cluster_size=100, member="IteratedLocalSearch", member_params=None,
+                 polish="IteratedLocalSearch", cluster_time_share=0.5, max_workers=None, seed=0):
+        super().__init__(distance_matrix)
+        # Cluster first, route second for large instances: the stops are split into clusters of about cluster_size
+        # (k-means on the coordinates if known, otherwise k-medoids on the travel times), every cluster is solved
+        # with the member method in parallel processes, the clusters are ordered by a small TSP between their
+        # medoids, and the stitched tour is improved by the polish method (None to skip) in the remaining time.
+        self.cluster_size = cluster_size
+        self.member = member
+        self.member_params = member_params or {}
+        self.polish = polish
+        self.cluster_time_share = cluster_time_share  # Share of the time limit for solving the clusters
+        self.max_workers = max_workers or os.cpu_count()
+        self.seed = seed
 
-        return optimal, np.array(tour) if tour else None
+    def solve(self, max_time_seconds):
+        start_time = self.start_timer()  # Record the start time
+        deadline = start_time + max_time_seconds
+        n = self.distance_matrix.shape[0]
+        if n <= self.cluster_size:
+            # Nothing to decompose
+            method = TSPMethodFactory.create_method(self.member, self.distance_matrix, **self.member_params)
+            return self._run_nested(method, max_time_seconds)
+
+        with profile_span(self.profiler, 'clustering'):
+            clusters = self._clusters(int(np.ceil(n / self.cluster_size)), np.random.default_rng(self.seed))
+        self.model_size.update(clusters=len(clusters), largest_cluster=max(len(cluster) for cluster in clusters))
+
+        with profile_span(self.profiler, 'cluster solves'):
+            tours = self._solve_clusters(clusters, start_time + max_time_seconds * self.cluster_time_share)
+        # Clusters without a tour from the member (e.g. too large for an exact method) get a constructed one
+        for index, cluster in enumerate(clusters):
+            if tours[index] is None:
+                cluster = np.asarray(cluster)
+                tours[index] = cluster[TourConstructor.construct('farthest_insertion', self.distance_matrix[np.ix_(cluster, cluster)])]
+
+        with profile_span(self.profiler, 'cluster order'):
+            order = self._cluster_order(clusters, deadline)
+        tour = self._stitch([np.asarray(tours[index]) for index in order])
+        self.report(tour)
+
+        if self.polish is None or time.time() >= deadline or self.should_stop():
+            self.report(tour, force=True)
+            return False, np.append(tour, tour[0])
+        with profile_span(self.profiler, 'polish'):
+            method = TSPMethodFactory.create_method(self.polish, self.distance_matrix)
+            method.initial_tour = tour
+            optimal, polished = self._run_nested(method, deadline - time.time())
+        if polished is None:
+            return False, np.append(tour, tour[0])
+        return False, polished
+
+    def _run_nested(self, method, max_time_seconds):
+        # Runs another method in this process, sharing the stop event and passing its reports on
+        method.coordinates = self.coordinates
+        method.symmetric = self.symmetric
+        # Stops together with this method, whether it is cancelled or stopped itself
+        method.stop_event = self.stop_event
+        method.stopped = self.stopped
+        method.set_progress_callback(lambda progress: self.report(progress['tour'], bound=progress['bound']), 0)
+        optimal, tour = method.solve(max_time_seconds)
+        for name, value in method.counters.items():
+            self.count(name, value)
+        if tour is not None:
+            self.report(tour, force=True)
+        return optimal, tour
+
+    def _clusters(self, k, rng):
+        # Lists of city indices, k-means on the coordinates or k-medoids on the symmetrized matrix
+        if self.coordinates is not None:
+            points = np.asarray(self.coordinates, dtype=float)
+            # Longitude degrees shrink towards the poles
+            points = np.column_stack([points[:, 0] * np.cos(np.radians(points[:, 1].mean())), points[:, 1]])
+            from scipy.cluster.vq import kmeans2
+            _, labels = kmeans2(points, k, minit='++', seed=int(rng.integers(2 ** 31)))
+        else:
+            labels = self._medoid_labels(k, rng)
+        return [np.flatnonzero(labels == label).tolist() for label in np.unique(labels)]
+
+    def _medoid_labels(self, k, rng, iterations=10):
+        cost = self.distance_matrix.astype(np.int64) + self.distance_matrix.T
+        # Spread the first medoids out, then alternate between assigning the cities and moving the medoids
+        medoids = [int(rng.integers(cost.shape[0]))]
+        distance = cost[medoids[0]].astype(float)
+        for _ in range(k - 1):
+            medoids.append(int(np.argmax(distance)))
+            distance = np.minimum(distance, cost[medoids[-1]])
+        for _ in range(iterations):
+            labels = np.argmin(cost[:, medoids], axis=1)
+            updated = []
+            for label in range(len(medoids)):
+                members = np.flatnonzero(labels == label)
+                if len(members):
+                    updated.append(int(members[np.argmin(cost[np.ix_(members, members)].sum(axis=1))]))
+            if updated == medoids:
+                break
+            medoids = updated
+        return np.argmin(cost[:, medoids], axis=1)
+
+    def _solve_clusters(self, clusters, deadline):
+        # Every cluster in its own process, with the matrix in shared memory as for PortfolioMethod
+        shared = SharedMatrix(self.distance_matrix, self.symmetric)
+
+        context = multiprocessing.get_context('spawn')
+        stop_event = context.Event()
+        executor = ProcessPoolExecutor(
+            max_workers=min(self.max_workers, len(clusters)), mp_context=context,
+            initializer=_init_portfolio_worker,
+            initargs=(shared.handle, stop_event, None)
+        )
+        # Without enough workers the clusters are solved in rounds, each round gets its share of the time
+        workers = min(self.max_workers, len(clusters))
+        start_time = time.time()
+        time_per_round = (deadline - start_time) / int(np.ceil(len(clusters) / workers))
+        try:
+            futures = []
+            for index, cluster in enumerate(clusters):
+                cluster_deadline = start_time + (index // workers + 1) * time_per_round
+                futures.append(executor.submit(_run_cluster_member, cluster, self.member, self.member_params, cluster_deadline))
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if self.should_stop():
+                    stop_event.set()
+            tours = [future.result() for future in futures]
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            shared.close()
+        self.count('cluster_solves', len(clusters))
+        return tours
+
+    def _cluster_order(self, clusters, deadline):
+        # A tour through the medoids of the clusters
+        if len(clusters) <= 3:
+            return list(range(len(clusters)))
+        medoids = [cluster[int(np.argmin(self.distance_matrix[np.ix_(cluster, cluster)].sum(axis=1)))] for cluster in clusters]
+        matrix = self.distance_matrix[np.ix_(medoids, medoids)]
+        if len(clusters) <= 12:
+            method = HeldKarpMethod(matrix)
+        else:
+            method = IteratedLocalSearchMethod(matrix, max_iterations_without_improvement=1000)
+        optimal, tour = method.solve(max(0.1, min(1.0, (deadline - time.time()) / 10)))
+        return [int(index) for index in tour[:-1]]
+
+    def _stitch(self, tours):
+        # Joins the cluster tours in the given order. Each cluster tour is entered at the city where arriving from the
+        # previous cluster minus the removed edge in front of that city is cheapest, and left from that city's predecessor.
+        d = self.distance_matrix
+        path = [tours[0]]
+        for tour in tours[1:]:
+            exit_city = path[-1][-1]
+            costs = d[exit_city, tour] - d[np.roll(tour, 1), tour]
+            k = int(np.argmin(costs))
+            path.append(np.roll(tour, -k))
+        return np.concatenate(path)
 
 class TSPMethodFactory:
     #add new methods here
     methods = {
         "TwoOpt": TwoOptMethod,
+        "IteratedLocalSearch": IteratedLocalSearchMethod,
         "Permutations": PermutationsMethod,
+        "HeldKarp": HeldKarpMethod,
         "FlowBased": FlowBasedMethod,
-        "ConstraintProgramming": ConstraintProgrammingMethod
+        "FlowBasedDFJ": partial(FlowBasedMethod, formulation='DFJ'),
+        "ConstraintProgramming": ConstraintProgrammingMethod,
+        "ConstraintProgrammingGLS": partial(ConstraintProgrammingMethod, metaheuristic='GUIDED_LOCAL_SEARCH'),
+        "Portfolio": PortfolioMethod,
+        "ClusterDecomposition": ClusterDecompositionMethod,
     }
 
+    # Other packages add methods through this entry point group, e.g. in their pyproject.toml
+    #   [project.entry-points."tsp_logic.methods"]
+    #   MyMethod = "my_package.my_module:MyMethod"
+    # Entry points are only imported when their method is created, and are found in every process (unlike register)
+    entry_point_group = 'tsp_logic.methods'
+
     @classmethod
-    def create_method(cls, method_name, distance_matrix):
-        if method_name in cls.methods:
-            return cls.methods[method_name](distance_matrix)
-        else:
-            raise ValueError(f"Unknown method: {method_name}")
+    def register(cls, method_name, method):
+        # method is a TSPMethod subclass (or a partial of one) or its "module:attribute" path, imported on first use
+        cls.methods[method_name] = method
+
+    @classmethod
+    def method_names(cls):
+        return list(cls.methods) + [entry_point.name for entry_point in entry_points(group=cls.entry_point_group)
+                                    if entry_point.name not in cls.methods]
+
+    @classmethod
+    def get_method(cls, method_name):
+        method = cls.methods.get(method_name)
+        if method is None:
+            found = entry_points(group=cls.entry_point_group, name=method_name)
+            if not found:
+                raise ValueError(f"Unknown method: {method_name}")
+            method = next(iter(found)).load()
+        elif isinstance(method, str):
+            module_name, attribute = method.split(':')
+            method = getattr(importlib.import_module(module_name), attribute)
+        cls.methods[method_name] = method
+        return method
+
+    @classmethod
+    def create_method(cls, method_name, distance_matrix, **params):
+        return cls.get_method(method_name)(distance_matrix, **params)
 
 class TSPSolver:
+    # The lower bound may take this fraction of the time limit, before and again after the method
+    bound_time_fraction = 0.1
+
     def __init__(self, distance_matrix, method):
-        self.distance_matrix = np.array(distance_matrix)
+        self.distance_matrix = as_distance_matrix(distance_matrix)  # No copy if it already is the method's matrix
         self.method = method
-
-    def solve_tsp(self, max_time_seconds):
-        return self.method.solve(max_time_seconds)
+        self.bound_time_seconds = None
+
+    def solve_tsp(self, max_time_seconds, gap_target=None):
+        # With gap_target (e.g. 0.01) a lower bound is computed first and the method stops
+        # as soon as its tour is proven to be within that fraction of the optimum
+        self.bound_time_seconds = self.bound_time_fraction * max_time_seconds
+        if gap_target is not None:
+            self.method.gap_target = gap_target
+            self.method.bound = LowerBound.compute(self.distance_matrix, symmetric=self.method.is_symmetric(),
+                                                   time_limit_seconds=self.bound_time_seconds)
+        optimal, tour = self.method.solve(max_time_seconds)
+        if tour is not None and not optimal and self.method.bound is not None and self.get_travel_time(tour) <= self.method.bound:
+            optimal = True  # The bound proves it
+        return optimal, tour
+
+    def quality(self, tour, optimal):
+        # Cost, lower bound and relative gap of the tour; a lower bound is computed if the method didn't provide one
+        cost = int(self.get_travel_time(tour))
+        if optimal:
+            bound = cost
+        else:
+            bound = self.method.bound
+            if bound is None:
+                bound = LowerBound.compute(self.distance_matrix, upper_bound=cost, symmetric=self.method.is_symmetric(),
+                                           time_limit_seconds=self.bound_time_seconds)
+        bound = min(int(bound), cost)
+        return {'cost': cost, 'bound': bound, 'gap': (cost - bound) / cost if cost > 0 else 0.0}
     
     def get_travel_time(self, tour):
-        return sum(self.distance_matrix[tour[i-1], tour[i]] for i in range(1, len(tour)))
+        tour = np.asarray(tour)
+        return int(self.distance_matrix[tour[:-1], tour[1:]].sum())
 
     def pretty_print(self, tour, locations):
         route = " -> ".join(str(i) for i in tour)
@@ -388,35 +2465,505 @@ class TSPSolver:
             print(f"Total Duration: {minutes} minute(s)")
 
 class TSPSolverInterface:
-    def __init__(self, API_KEY):
-        self.calculator = TravelTimeCalculator(API_KEY)
-
-    def solve_tsp(self, locations, mode, method_name, max_time_seconds):
-        # Calculate travel times
-        travel_times = self.calculator.get_travel_time(locations, mode)
-        print("cost Matrix", travel_times)
-        if not any(None in sublist for sublist in travel_times):
-            # Check the selected method and create the appropriate method instance
-            method = TSPMethodFactory.create_method(method_name, travel_times)
-
-            solver = TSPSolver(travel_times, method)
-            
-            optimal, tour = solver.solve_tsp(max_time_seconds)
-            if tour is None:
-                return False, None, None, None
-            solver.pretty_print(tour, locations)  # Pass locations to pretty_print method
-            total_time_minutes = solver.get_travel_time(tour) / 60
-            ordered_locations = [locations[i] for i in tour]
-
-            # Visualize the tour
-            route = self.calculator.visualize_tsp_tour(locations, tour, mode, total_time_minutes, ordered_locations)
-
-            # Return the locations in the order they should be visited
-            return optimal, ordered_locations, total_time_minutes, route
+    def __init__(self, API_KEY, cache_path='travel_cache.sqlite'):
+        # cache_path=None disables the persistent geocode/matrix cache and the stored solve results
+        self.cache = TravelCache(cache_path) if cache_path else None
+        self.solve_cache = SolveCache(self.cache) if self.cache is not None else None
+        self.calculator = TravelTimeCalculator(API_KEY, self.cache)
+        # Matrix and tour of the last successful solve, so that adding or removing a few stops
+        # only fetches the new rows and columns and warm starts from the previous tour
+        self.previous_solve = None
+        self.last_timing = None  # SolveProfiler report of the last solve
+
+    def get_duration_matrix(self, coordinates, mode):
+        # Returns the duration matrix and a start tour (None if there is no previous solve to build on).
+        # Stops are matched to the previous solve by their coordinates, the durations between kept stops are reused
+        # and only the pairs involving new stops are fetched; the new stops are inserted into the previous tour.
+        keys = [TravelCache.coordinate_key(coordinate) for coordinate in coordinates]
+        previous = self.previous_solve
+        if previous is None or previous['mode'] != mode or len(set(keys)) != len(keys):
+            return self.calculator.get_duration_matrix(coordinates, mode), None
+        previous_index = {key: i for i, key in enumerate(previous['keys'])}
+        kept = [i for i, key in enumerate(keys) if key in previous_index]
+        added = [i for i, key in enumerate(keys) if key not in previous_index]
+        if len(kept) < 2 or len(kept) < len(previous['keys']) / 2:
+            return self.calculator.get_duration_matrix(coordinates, mode), None
+
+        n = len(coordinates)
+        matrix = np.empty((n, n), dtype=np.int32)
+        old = [previous_index[keys[i]] for i in kept]
+        matrix[np.ix_(kept, kept)] = previous['matrix'][np.ix_(old, old)]
+        if added:
+            # The rows of the new stops to all stops, then only the kept stops to the new ones
+            rows = self.calculator.get_duration_block(coordinates, mode, added, list(range(n)))
+            cols = self.calculator.get_duration_block(coordinates, mode, kept, added)
+            if rows is None or cols is None:
+                return None, None
+            matrix[added, :] = rows
+            matrix[np.ix_(kept, added)] = cols
+        print(f"Reused {len(kept)} stops of the previous solve, fetched {len(added)} new")
+
+        # The previous tour without the removed stops, in the new indices, with the new stops inserted
+        new_index = {previous_index[keys[i]]: i for i in kept}
+        tour = [new_index[city] for city in previous['tour'] if city in new_index]
+        return matrix, TourConstructor.insert(matrix, tour, added)
+
+    def solve_tsp(self, locations, mode, method_name, max_time_seconds, coordinates=None, progress_callback=None, stop_event=None, gap_target=None,
+                  visualize=True, verbose=True, profile=False, candidates=None):
+        # coordinates are optional (lon, lat) pairs of the locations, e.g. the positions already shown in the app.
+        # Otherwise the locations are geocoded once here and reused for the route geometry.
+        # progress_callback receives the progress dicts of TSPMethod.report with the 'ordered_locations' added,
+        # setting stop_event (a threading.Event) ends the solve early with the best tour found so far.
+        # visualize=False skips the route geometry and the html map (route is None then), verbose=False the printing.
+        # The timing report of the solve is kept in last_timing, profile=True adds the cProfile statistics.
+        # candidates=k only requests the travel times from every stop to its k nearest stops and the edges of the
+        # found tour instead of the full matrix, the other pairs are estimated (see _solve_with_candidates).
+        # Returns optimal, ordered_locations, total_time_minutes, route (a RouteGeometry) and the quality dict of TSPSolver.quality.
+        profiler = SolveProfiler(profile)
+        self.calculator.profiler = self.calculator.http.profiler = profiler
+        try:
+            with profiler.profiling():
+                return self._solve_tsp(locations, mode, method_name, max_time_seconds, coordinates, progress_callback, stop_event,
+                                       gap_target, visualize, verbose, profiler, candidates)
+        finally:
+            self.calculator.profiler = self.calculator.http.profiler = None
+            self.last_timing = profiler.report()
+            if verbose:
+                print("Timing", SolveProfiler.format(self.last_timing))
+
+    def _solve_tsp(self, locations, mode, method_name, max_time_seconds, coordinates, progress_callback, stop_event, gap_target,
+                   visualize, verbose, profiler, candidates):
+        if coordinates is None:
+            with profiler.span('geocode'):
+                coordinates = self.calculator.get_coordinates(locations)
+            if coordinates is None:
+                return None, None, None, None, None
+        elif len(coordinates) != len(locations):
+            raise ValueError("coordinates must contain one (lon, lat) pair per location")
+        coordinates = [(float(lon), float(lat)) for lon, lat in coordinates]
+
+        if candidates is not None:
+            with profiler.span('matrix'):
+                durations = self.calculator.get_candidate_durations(coordinates, mode, candidates)
+            if durations is None:
+                return None, None, None, None, None
+            optimal, tour, quality = self._solve_with_candidates(durations, locations, mode, method_name, max_time_seconds, coordinates,
+                                                                 progress_callback, stop_event, gap_target, verbose, profiler)
+            # The matrix is partly estimated, so the next solve starts over
+            self.previous_solve = None
         else:
+            # Calculate travel times
+            with profiler.span('matrix'):
+                travel_times, initial_tour = self.get_duration_matrix(coordinates, mode)
+            if verbose:
+                print("cost Matrix", travel_times)
+            if travel_times is None:
+                return None, None, None, None, None
+
+            optimal, tour, quality = self.solve_matrix(travel_times, locations, method_name, max_time_seconds, coordinates, initial_tour,
+                                                       progress_callback, stop_event, gap_target, verbose, profiler)
+            if tour is not None:
+                self.previous_solve = {
+                    'mode': mode,
+                    'keys': [TravelCache.coordinate_key(coordinate) for coordinate in coordinates],
+                    'matrix': travel_times,
+                    'tour': [int(city) for city in tour[:-1]],
+                }
+        if tour is None:
+            return optimal, None, None, None, None
+        total_time_minutes = quality['cost'] / 60
+        ordered_locations = [locations[i] for i in tour]
+
+        # Visualize the tour
+        # A cancelled solve returns its tour right away, and a failed geometry request only costs the map, not the tour
+        route = None
+        if visualize and (stop_event is None or not stop_event.is_set()):
+            try:
+                route = self.calculator.visualize_tsp_tour(locations, tour, mode, total_time_minutes, ordered_locations, coordinates)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print(f"Error: the route geometry could not be fetched ({e!r})")
+        if verbose:
+            if self.cache is not None:
+                print("Cache statistics", self.cache.stats())
+            print("Request statistics", self.calculator.http.stats())
+
+        # Return the locations in the order they should be visited
+        return optimal, ordered_locations, total_time_minutes, route, quality
+
+    def _solve_with_candidates(self, durations, locations, mode, method_name, max_time_seconds, coordinates, progress_callback=None,
+                               stop_event=None, gap_target=None, verbose=True, profiler=None, max_rounds=3):
+        # Solves with the real durations of the candidate pairs and estimates for all other pairs, then requests the
+        # edges of the tour that are still estimated and solves again from that tour, until the tour only uses real
+        # durations or max_rounds re-solves are done. Returns like solve_matrix, the cost is always the real one.
+        # Bounds of the partly estimated matrix don't bound the real tour, so the result has no bound or gap (unless it
+        # is optimal) and gap_target is ignored
+        deadline = time.time() + max_time_seconds
+        if progress_callback is not None:
+            report_progress = progress_callback
+
+            def progress_callback(progress):
+                return report_progress(dict(progress, bound=None, gap=None))
+        if verbose:
+            print(f"Requested {durations.known_fraction():.1%} of the travel time matrix")
+        initial_tour = None
+        time_limit = max_time_seconds * 0.7
+        for attempt in range(max_rounds + 1):
+            optimal, tour, quality = self.solve_matrix(durations.matrix(), locations, method_name, time_limit, coordinates, initial_tour,
+                                                       progress_callback, stop_event, None, verbose, profiler, durations.candidates)
+            if tour is None:
+                return optimal, None, None
+            missing = durations.missing(zip(tour[:-1], tour[1:]))
+            if not missing:
+                break
+            with profile_span(profiler, 'tour edges'):
+                if not self.calculator.fetch_pairs(coordinates, mode, durations, missing):
+                    return None, None, None
+            if verbose:
+                print(f"Requested {len(missing)} estimated edge(s) of the tour")
+            if attempt == max_rounds or (stop_event is not None and stop_event.is_set()):
+                break
+            initial_tour = tour[:-1]
+            time_limit = max((deadline - time.time()) / (max_rounds - attempt), 1)
+
+        unreachable = durations.unreachable(zip(tour[:-1], tour[1:]))
+        if unreachable:
+            print('No travel times were obtained for the following connections:')
+            for i, j in unreachable:
+                print(f"{locations[i]} -> {locations[j]}")
+            return None, None, None
+        # Optimality refers to the partly estimated matrix, so it only counts if nothing was estimated
+        matrix = durations.matrix()
+        cost = int(matrix[tour[:-1], tour[1:]].sum())
+        optimal = optimal and cost == quality['cost'] and durations.known_fraction() >= 1
+        if optimal:
+            return optimal, tour, {'cost': cost, 'bound': cost, 'gap': 0.0}
+        return optimal, tour, {'cost': cost, 'bound': None, 'gap': None}
+
+    def solve_matrix(self, travel_times, locations, method_name, max_time_seconds, coordinates=None, initial_tour=None,
+                     progress_callback=None, stop_event=None, gap_target=None, verbose=True, profiler=None, candidate_lists=None,
+                     method_params=None):
+        # Solves a given matrix of travel times in seconds, locations only name the stops in the output.
+        # Returns optimal, the closed tour of indices and the quality dict; None, None, None if a connection is missing
+        if (travel_times == TravelTimeCalculator.UNREACHABLE).any():
             print('No travel times were obtained for the following connections:')
-            for i in range(len(travel_times)):
-                for j in range(len(travel_times[i])):
-                    if travel_times[i][j] is None:
-                        print(f"{locations[i]} -> {locations[j]}")
-            return None, None, None, None
\ No newline at end of file
+            for i, j in np.argwhere(travel_times == TravelTimeCalculator.UNREACHABLE):
+                print(f"{locations[i]} -> {locations[j]}")
+            return None, None, None
+
+        # The same matrix was solved with the same method before: return that result if it is final (see
+        # SolveCache.is_final), otherwise continue from its tour
+        key = stored = None
+        if self.solve_cache is not None:
+            with profile_span(profiler, 'stored result'):
+                key = SolveCache.fingerprint(travel_times, method_name, method_params, candidate_lists, gap_target)
+                stored = self.solve_cache.get(key)
+        if stored is not None:
+            if SolveCache.is_final(stored, max_time_seconds, gap_target):
+                if verbose:
+                    print(f"Reusing the stored result of an earlier solve ({stored['seconds']:g} seconds)")
+                return stored['optimal'], np.array(stored['tour']), SolveCache.quality(stored)
+            initial_tour = stored['tour'][:-1]
+
+        # Check the selected method and create the appropriate method instance
+        method = TSPMethodFactory.create_method(method_name, travel_times, **(method_params or {}))
+        method.coordinates = coordinates
+        method.initial_tour = initial_tour
+        method.candidate_lists = candidate_lists
+        if profiler is not None:
+            method.profiler = profiler
+            profiler.method = method
+        if progress_callback is not None:
+            def on_progress(progress):
+                progress['ordered_locations'] = [locations[i] for i in progress['tour']]
+                return progress_callback(progress)
+            method.set_progress_callback(on_progress)
+        if stop_event is not None:
+            method.stop_event = stop_event
+
+        solver = TSPSolver(method.distance_matrix, method)
+
+        start_time = time.time()
+        with profile_span(profiler, 'solve'):
+            optimal, tour = solver.solve_tsp(max_time_seconds, gap_target)
+        # A solve that was cancelled or reached the gap target only ran until then
+        stopped_early = method.stop_reason is not None or (stop_event is not None and stop_event.is_set())
+        seconds = time.time() - start_time if stopped_early else max_time_seconds
+        if tour is None:
+            return False, None, None
+        with profile_span(profiler, 'bound'):
+            quality = solver.quality(tour, optimal)
+        if stored is not None:
+            # Methods that ignore the start tour may end up worse than the stored result, both bounds hold
+            bound = max(quality['bound'], stored['bound'])
+            if stored['cost'] < quality['cost']:
+                tour = np.array(stored['tour'])
+                quality = SolveCache.quality(dict(stored, bound=bound))
+            else:
+                quality = SolveCache.quality(dict(quality, bound=min(bound, quality['cost'])))
+            optimal = optimal or quality['bound'] >= quality['cost']
+            seconds = max(seconds, stored['seconds'])
+        if key is not None:
+            self.solve_cache.set(key, {'tour': [int(city) for city in tour], 'cost': quality['cost'], 'bound': quality['bound'],
+                                       'optimal': bool(optimal), 'seconds': seconds})
+        if verbose:
+            solver.pretty_print(tour, locations)  # Pass locations to pretty_print method
+            print(f"Lower bound: {quality['bound']}, gap: {quality['gap']:.2%}")
+        return optimal, tour, quality
+
+_worker_interface = None
+
+def _run_solve_job(API_KEY, cache_path, jobs, job_id, cancel_event, args):
+    # Runs in a worker process of SolveJobManager, progress and the result are written to the shared jobs dict
+    global _worker_interface
+    if _worker_interface is None:
+        _worker_interface = TSPSolverInterface(API_KEY, cache_path)
+
+    if cancel_event.is_set():
+        jobs[job_id] = dict(jobs[job_id], status='cancelled', finished=time.time())
+        return
+    jobs[job_id] = dict(jobs[job_id], status='running', started=time.time())
+
+    # Polling the shared event costs a round trip to the manager, the solver checks a local copy instead
+    stop_event = threading.Event()
+    finished = threading.Event()
+
+    def watch():
+        while not finished.wait(0.2):
+            if cancel_event.is_set():
+                stop_event.set()
+                return
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+
+    def on_progress(progress):
+        jobs[job_id] = dict(jobs[job_id], progress={
+            'cost': progress['cost'],
+            'tour': progress['tour'].tolist(),
+            'ordered_locations': progress['ordered_locations'],
+            'elapsed': progress['elapsed'],
+            'bound': progress['bound'],
+            'gap': progress['gap'],
+        })
+
+    try:
+        locations, mode, method_name, max_time_seconds, coordinates, gap_target, candidates = args
+        result = _worker_interface.solve_tsp(locations, mode, method_name, max_time_seconds, coordinates,
+                                             progress_callback=on_progress, stop_event=stop_event, gap_target=gap_target,
+                                             candidates=candidates)
+    except Exception as e:
+        jobs[job_id] = dict(jobs[job_id], status='failed', error=repr(e), finished=time.time())
+        return
+    finally:
+        finished.set()
+        watcher.join()
+
+    status = 'cancelled' if stop_event.is_set() else 'done'
+    jobs[job_id] = dict(jobs[job_id], status=status, result=result, timing=_worker_interface.last_timing, finished=time.time())
+
+class SolveJobManager:
+    # Runs TSPSolverInterface.solve_tsp calls as background jobs in a process pool.
+    # Job states: 'queued', 'running', 'done', 'cancelled' or 'failed'. While running, 'progress' holds the
+    # best tour so far; once finished, 'result' holds the return value of solve_tsp and 'error' a failure.
+    def __init__(self, API_KEY, cache_path='travel_cache.sqlite', max_workers=None, keep_seconds=3600):
+        self.API_KEY = API_KEY
+        self.cache_path = cache_path
+        self.max_workers = max_workers or os.cpu_count()
+        self.keep_seconds = keep_seconds  # Finished jobs are forgotten after this time
+        self.lock = threading.Lock()
+        self.manager = None
+        self.executor = None
+        self.jobs = None
+        self.cancel_events = {}
+        self.futures = {}
+
+    def _start(self):
+        # The processes are only started on the first submit, spawned so they don't inherit the app's threads
+        if self.executor is None:
+            context = multiprocessing.get_context('spawn')
+            self.manager = context.Manager()
+            self.jobs = self.manager.dict()
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    def submit(self, locations, mode, method_name, max_time_seconds, coordinates=None, gap_target=None, candidates=None):
+        with self.lock:
+            self._start()
+            self._forget_finished()
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'status': 'queued', 'submitted': time.time(), 'progress': None, 'result': None, 'error': None}
+            self.cancel_events[job_id] = self.manager.Event()
+            args = (locations, mode, method_name, max_time_seconds, coordinates, gap_target, candidates)
+            self.futures[job_id] = self.executor.submit(
+                _run_solve_job, self.API_KEY, self.cache_path, self.jobs, job_id, self.cancel_events[job_id], args
+            )
+        return job_id
+
+    def status(self, job_id):
+        with self.lock:
+            if self.jobs is None or job_id not in self.jobs:
+                return None
+            job = dict(self.jobs[job_id])
+            future = self.futures.get(job_id)
+        # A worker that died never gets to write its state
+        # (a job cancelled before it started has no exception to ask for)
+        if future is not None and future.done() and not future.cancelled() and future.exception() is not None \
+                and job['status'] in ('queued', 'running'):
+            job = dict(job, status='failed', error=repr(future.exception()))
+        return job
+
+    def cancel(self, job_id):
+        with self.lock:
+            if job_id not in self.cancel_events:
+                return False
+            self.cancel_events[job_id].set()
+            if self.futures[job_id].cancel():
+                self.jobs[job_id] = dict(self.jobs[job_id], status='cancelled', finished=time.time())
+            return True
+
+    def _forget_finished(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job['status'] in ('done', 'cancelled', 'failed') and now - job.get('finished', now) > self.keep_seconds:
+                del self.jobs[job_id]
+                self.cancel_events.pop(job_id, None)
+                self.futures.pop(job_id, None)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                for event in self.cancel_events.values():
+                    event.set()
+                self.executor.shutdown(wait=True, cancel_futures=True)
+                self.manager.shutdown()
+                self.executor = None
+
+_batch_interface = None
+
+def _init_batch_worker(API_KEY, cache_path):
+    # Solver messages go to stderr, so that a batch can stream its results to stdout. Redirected at the file
+    # descriptor, so native solver output and the member processes of Portfolio and ClusterDecomposition follow
+    global _batch_interface
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), 1)
+    sys.stdout = sys.stderr
+    _batch_interface = TSPSolverInterface(API_KEY, cache_path)
+
+def _run_batch_job(job, visualize, output_dir, grace_seconds, profile):
+    # Runs in a worker process of solve_batch and returns the result dict of one job
+    start = time.time()
+    result = {'id': job['id'], 'status': 'failed', 'optimal': None, 'tour': None, 'ordered_locations': None,
+              'cost': None, 'bound': None, 'gap': None, 'total_time_minutes': None, 'html': None, 'error': None}
+    # Methods check the time limit themselves, the timer stops those that overrun it
+    stop_event = threading.Event()
+    timer = threading.Timer(job['max_time_seconds'] + grace_seconds, stop_event.set)
+    timer.daemon = True
+    profiler = SolveProfiler(profile)
+    calculator = _batch_interface.calculator
+    calculator.profiler = calculator.http.profiler = profiler
+    try:
+        with profiler.profiling():
+            _solve_batch_job(job, visualize, output_dir, timer, stop_event, profiler, result)
+    except Exception as e:
+        result['error'] = repr(e)
+    finally:
+        timer.cancel()
+        calculator.profiler = calculator.http.profiler = None
+        result['elapsed'] = time.time() - start
+        result['timing'] = profiler.report()
+    return result
+
+def _solve_batch_job(job, visualize, output_dir, timer, stop_event, profiler, result):
+    locations = job.get('locations')
+    coordinates = job.get('coordinates')
+    mode = job.get('mode', 'driving')
+    calculator = _batch_interface.calculator
+    if 'matrix' in job:
+        travel_times = np.rint(np.asarray(job['matrix'], dtype=float)).astype(np.int32)
+        if travel_times.ndim != 2 or travel_times.shape[0] != travel_times.shape[1]:
+            raise ValueError("matrix must be square")
+        if locations is None:
+            locations = [str(i) for i in range(travel_times.shape[0])]
+    else:
+        if not locations:
+            raise ValueError("a job needs either 'locations' or 'matrix'")
+        if coordinates is None:
+            with profiler.span('geocode'):
+                coordinates = calculator.get_coordinates(locations)
+            if coordinates is None:
+                result['error'] = "Some locations could not be geocoded"
+                return
+        coordinates = [(float(lon), float(lat)) for lon, lat in coordinates]
+        with profiler.span('matrix'):
+            if job.get('candidates') is not None:
+                durations = calculator.get_candidate_durations(coordinates, mode, job['candidates'])
+                travel_times = None if durations is None else durations.estimate
+            else:
+                travel_times = calculator.get_duration_matrix(coordinates, mode)
+        if travel_times is None:
+            result['error'] = "The travel time matrix could not be fetched"
+            return
+    if len(locations) != travel_times.shape[0]:
+        raise ValueError("locations and matrix sizes differ")
+
+    timer.start()
+    if job.get('candidates') is not None and 'matrix' not in job:
+        optimal, tour, quality = _batch_interface._solve_with_candidates(durations, locations, mode, job.get('method', 'TwoOpt'),
+                                                                         job['max_time_seconds'], coordinates, stop_event=stop_event,
+                                                                         gap_target=job.get('gap_target'), verbose=False, profiler=profiler)
+    else:
+        optimal, tour, quality = _batch_interface.solve_matrix(travel_times, locations, job.get('method', 'TwoOpt'), job['max_time_seconds'],
+                                                               coordinates, stop_event=stop_event, gap_target=job.get('gap_target'),
+                                                               verbose=False, profiler=profiler)
+    if tour is None:
+        result['error'] = "No tour found" if optimal is False else "Some locations are not connected"
+        return
+    ordered_locations = [locations[i] for i in tour]
+    result.update(status='done', optimal=bool(optimal), tour=[int(city) for city in tour], ordered_locations=ordered_locations,
+                  cost=quality['cost'], bound=quality['bound'], gap=quality['gap'], total_time_minutes=quality['cost'] / 60)
+
+    if visualize and coordinates is not None and 'matrix' not in job:
+        html_path = os.path.join(output_dir, f"route_{job['id']}.html")
+        if calculator.visualize_tsp_tour(locations, tour, mode, quality['cost'] / 60, ordered_locations, coordinates, html_path) is not None:
+            result['html'] = html_path
+
+def solve_batch(jobs, API_KEY=None, cache_path='travel_cache.sqlite', max_workers=None, max_time_seconds=10, visualize=False,
+                output_dir='.', grace_seconds=5, profile=False):
+    # Solves many instances without the app and yields one result dict per job as soon as it is finished
+    # (so not necessarily in input order). Every job is a dict with either 'locations' (and optionally 'coordinates'
+    # and 'mode') or a precomputed 'matrix' of travel times in seconds, plus optional 'id', 'method' (default TwoOpt),
+    # 'max_time_seconds', 'gap_target' and 'candidates' (see TSPSolverInterface.solve_tsp). API_KEY is only needed for jobs without a matrix.
+    # Maps are only rendered with visualize=True, to output_dir/route_<id>.html.
+    # Every result carries the timing report of its solve, with the cProfile statistics if profile=True.
+    max_workers = max_workers or os.cpu_count()
+    context = multiprocessing.get_context('spawn')
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                   initializer=_init_batch_worker, initargs=(API_KEY, cache_path))
+    jobs = iter(jobs)
+    pending = {}
+    exhausted = False
+    index = 0
+    try:
+        while True:
+            # Only a few jobs per worker are queued, so long inputs are read as they are solved
+            while not exhausted and len(pending) < 2 * max_workers:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                job = dict(job)
+                job.setdefault('id', index)
+                job.setdefault('max_time_seconds', max_time_seconds)
+                index += 1
+                pending[executor.submit(_run_batch_job, job, visualize, output_dir, grace_seconds, profile)] = job['id']
+            if not pending:
+                break
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id = pending.pop(future)
+                if future.exception() is not None:
+                    # The worker process died
+                    yield {'id': job_id, 'status': 'failed', 'error': repr(future.exception())}
+                else:
+                    yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)